@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import fcntl
+import shutil
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Replacement for aws-sync.sh, run via cron every minute. MediaWiki appends the path of every
+# moved or re-uploaded file to needsync.txt; each listed file is copied from the source bucket
+# to every regional bucket. Paths are de-duplicated and all (path, bucket) copies run
+# concurrently over one pooled client, with retries. Buckets are given as s3://bucket URLs, or
+# as local directories, which is how the copy logic can be tried without AWS.
+#
+# needsync.txt is atomically renamed to needsync.txt.processing before it is read, so paths
+# appended while a batch is copied wait for the next batch. Each finished (bucket, path) copy is
+# recorded in a journal next to it; after a crash the batch is resumed and only the copies
+# missing from the journal are made.
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+SOURCE_BUCKET = 's3://bahaimedia'
+DEST_BUCKETS = ['s3://bahaimedia-eu', 's3://bahaimedia-sg', 's3://bahaimedia-sp']
+NEEDSYNC_FILE = '/var/log/mediawiki/needsync.txt'
+
+DEFAULT_WORKERS = 16
+DEFAULT_ATTEMPTS = 5
+
+class S3Backend:
+    def __init__(self, workers):
+        if boto3 is None:
+            raise RuntimeError("boto3 is required to copy between S3 buckets.")
+        # One thread-safe client whose connection pool is shared by all copy threads. Failed
+        # requests are retried by copy_with_retries only, so botocore makes a single attempt.
+        self.client = boto3.client('s3', config=Config(
+            max_pool_connections=workers,
+            retries={'mode': 'standard', 'max_attempts': 1},
+        ))
+
+    # Server-side copy; large objects are copied in parts by the managed transfer
+    def copy(self, source, destination, path):
+        try:
+            self.client.copy({'Bucket': bucket_name(source), 'Key': path}, bucket_name(destination), path)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(f"{source}/{path} does not exist") from e
+            raise
+
+class LocalBackend:
+    def copy(self, source, destination, path):
+        target = os.path.join(destination, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Copy to a temporary name and rename so readers never see a partial file
+        temp_path = f"{target}.sync-{os.getpid()}"
+        shutil.copy2(os.path.join(source, path), temp_path)
+        os.replace(temp_path, target)
+
+# Append-only record of the copies finished in the current batch, one "bucket<TAB>path" per line
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    # A line cut short by a crash has no newline and is ignored
+                    if line.endswith('\n') and '\t' in line:
+                        self.done.add(tuple(line[:-1].split('\t', 1)))
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def record(self, destination, path):
+        with self.lock:
+            self.file.write(f"{destination}\t{path}\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def remove(self):
+        self.file.close()
+        os.unlink(self.path)
+
+def bucket_name(url):
+    return url[len('s3://'):].rstrip('/')
+
+# Pick the backend from the bucket URLs; S3 and local buckets cannot be mixed
+def get_backend(buckets, workers):
+    if all(bucket.startswith('s3://') for bucket in buckets):
+        return S3Backend(workers)
+    if not any(bucket.startswith('s3://') for bucket in buckets):
+        return LocalBackend()
+    raise ValueError("Source and destination buckets must all be S3 or all be local directories.")
+
+# Read the listed paths, trimmed, without empty lines, comments or duplicates, in listed order
+def read_paths(file_path):
+    paths = {}
+    with open(file_path, encoding='utf-8') as file:
+        for line in file:
+            path = line.strip().lstrip('/')
+            if path and not path.startswith('#'):
+                paths[path] = None
+    return list(paths)
+
+# Copy one path to one bucket, retrying with exponential backoff, and record it in the
+# journal; returns the error or None
+def copy_with_retries(backend, journal, source, destination, path, attempts):
+    error = None
+    for attempt in range(attempts):
+        try:
+            backend.copy(source, destination, path)
+            journal.record(destination, path)
+            return None
+        except FileNotFoundError as e:
+            # Deleted (or moved again) since it was listed; retrying cannot help
+            return e
+        except Exception as e:
+            error = e
+            if attempt + 1 < attempts:
+                time.sleep(min(2 ** attempt, 30))
+    return error
+
+# Copy every path to every destination concurrently, skipping the copies already in the journal;
+# returns the paths with a failed copy and the paths missing from the source
+def sync_paths(backend, journal, source, destinations, paths, workers, attempts):
+    failed = set()
+    missing = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(copy_with_retries, backend, journal, source, destination, path, attempts): (path, destination)
+            for path in paths for destination in destinations if (destination, path) not in journal.done
+        }
+        for future, (path, destination) in futures.items():
+            error = future.result()
+            if isinstance(error, FileNotFoundError):
+                if path not in missing:
+                    print(f"Skipping {path}: {error}")
+                missing.add(path)
+            elif error is not None:
+                print(f"Failed to copy {path} to {destination}: {error}")
+                failed.add(path)
+    return [path for path in paths if path in failed], missing
+
+# Return the batch to work on: an unfinished batch left by an interrupted run, or else the
+# current list renamed out of MediaWiki's way. None when there is nothing to sync.
+def claim_batch(needsync_file):
+    processing_file = needsync_file + '.processing'
+    if os.path.exists(processing_file):
+        return processing_file
+    try:
+        os.replace(needsync_file, processing_file)
+    except FileNotFoundError:
+        return None
+    return processing_file
+
+# Put failed paths back in needsync.txt so the next run retries them
+def requeue(needsync_file, paths):
+    with open(needsync_file, 'a', encoding='utf-8') as file:
+        for path in paths:
+            file.write(path + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy the files listed in needsync.txt to the regional buckets.')
+    parser.add_argument('--needsync', type=str, default=NEEDSYNC_FILE, help='File listing the paths to sync')
+    parser.add_argument('--source', type=str, default=SOURCE_BUCKET, help='Source bucket (s3://name) or directory')
+    parser.add_argument('--dest', type=str, nargs='+', default=DEST_BUCKETS, help='Destination buckets (s3://name) or directories')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of copies run concurrently')
+    parser.add_argument('--attempts', type=int, default=DEFAULT_ATTEMPTS, help='Attempts per copy before the path is requeued')
+    args = parser.parse_args()
+    if args.attempts < 1:
+        parser.error("--attempts must be at least 1")
+
+    # Cron starts a run every minute; let a long run finish instead of copying the same files twice
+    lock = open(args.needsync + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("Another sync is still running.")
+        return 0
+
+    backend = get_backend([args.source] + args.dest, args.workers)
+
+    # Finish an interrupted batch first; paths listed again since then are in the next batch
+    batches = 0
+    while True:
+        resumed = os.path.exists(args.needsync + '.processing')
+        processing_file = claim_batch(args.needsync)
+        if processing_file is None:
+            break
+        batches += 1
+        journal = Journal(processing_file + '.journal')
+        if journal.done:
+            print(f"Resuming an interrupted batch with {len(journal.done)} copies already done.")
+
+        paths = read_paths(processing_file)
+        start = time.monotonic()
+        failed, missing = sync_paths(backend, journal, args.source, args.dest, paths, args.workers, args.attempts)
+        if failed:
+            requeue(args.needsync, failed)
+        # The batch is complete once its failures are requeued
+        os.unlink(processing_file)
+        journal.remove()
+        print(f"Synced {len(paths) - len(failed) - len(missing)} of {len(paths)} files to {len(args.dest)} buckets "
+              f"in {time.monotonic() - start:.1f}s, {len(failed)} requeued, {len(missing)} missing.")
+        if not resumed:
+            break
+    return 0 if batches else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import mmap
+from contextlib import contextmanager
+from urllib.parse import unquote
+
+# Shared reader for AWStats data files. The file is memory-mapped and the BEGIN_MAP
+# offsets are used to slice out only the byte range of the sections a script asks for,
+# so the rest of a multi-megabyte monthly file is never read or decoded.
+
+# Open an AWStats data file and memory-map it read-only
+@contextmanager
+def open_data_file(file_path):
+    with open(file_path, 'rb') as file:
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            yield b''
+            return
+        try:
+            yield data
+        finally:
+            data.close()
+
+# Return the (start, end) byte range of a section, from its offset up to its END_ line
+def section_range(data, offset, name):
+    end = data.find(b'\nEND_' + name.encode('ascii'), offset)
+    if end == -1:
+        end = len(data)
+    return offset, end
+
+# Yield the raw lines of a section without decoding them
+def iter_section_lines(data, offset, name):
+    pos, end = section_range(data, offset, name)
+    while pos < end:
+        newline = data.find(b'\n', pos, end)
+        if newline == -1:
+            newline = end
+        yield data[pos:newline]
+        pos = newline + 1
+
+# Yield the whitespace-separated fields of every record line in a section,
+# skipping the BEGIN_ line and comments on their first bytes
+def iter_records(data, offset, name):
+    for line in iter_section_lines(data, offset, name):
+        if line.startswith(b'#') or line.startswith(b'BEGIN_'):
+            continue
+        parts = line.split()
+        if parts:
+            yield parts
+
+# Parse the BEGIN_MAP section to get positions
+def parse_begin_map(data):
+    positions = {}
+    end = data.find(b'\nEND_MAP')
+    if end == -1:
+        end = len(data)
+    start = data.find(b'BEGIN_MAP', 0, end)
+    for line in data[max(start, 0):end].split(b'\n'):
+        parts = line.split()
+        if len(parts) == 2 and parts[0].startswith(b'POS_'):
+            positions[parts[0].decode('ascii')] = int(parts[1])
+    return positions
+
+# Extract TotalUnique from POS_GENERAL
+def parse_pos_general(data, pos_general_offset):
+    start, end = section_range(data, pos_general_offset, 'GENERAL')
+    pos = data.find(b'\nTotalUnique', start, end)
+    if pos == -1:
+        return None
+    line_end = data.find(b'\n', pos + 1, end)
+    return int(data[pos:line_end if line_end != -1 else end].split()[1])
+
+# Extract daily data from POS_DAY
+def parse_pos_day(data, pos_day_offset):
+    daily_data = []
+    for parts in iter_records(data, pos_day_offset, 'DAY'):
+        if len(parts) == 5:
+            date_str, pages, hits, bandwidth, visits = parts
+            daily_data.append({
+                'year': int(date_str[:4]),
+                'month': int(date_str[4:6]),
+                'day': int(date_str[6:8]),
+                'pages': int(pages),
+                'hits': int(hits),
+                'bandwidth': int(bandwidth),
+                'number_of_visits': int(visits)
+            })
+    return daily_data
+
+# Turn a SIDER URL into a MediaWiki page title
+def normalize_url(url):
+    # Remove leading slash if present
+    if url.startswith('/'):
+        url = url[1:]
+
+    # Remove 'wiki/' prefix if present
+    if url.startswith('wiki/'):
+        url = url[len('wiki/'):]
+
+    # Decode URL-encoded characters
+    url = unquote(url)
+
+    # Replace underscores with spaces
+    return url.replace('_', ' ')
+
+# Raw SIDER URL prefixes of MediaWiki entry points and static assets. With capitalized titles
+# (MediaWiki's default) no page title can start with them, so their lines are dropped before
+# any decoding or normalization.
+NON_PAGE_PREFIXES = (b'/images/', b'/skins/', b'/resources/', b'/extensions/', b'/load.php',
+                     b'/api.php', b'/rest.php', b'/index.php', b'/favicon.ico', b'/robots.txt')
+
+# Stream POS_SIDER records as (url, fields) with the URL normalized and the counter fields
+# (Pages, Bandwidth, Entry, Exit) still raw bytes, so callers only parse the records they keep
+def iter_pos_sider(data, pos_sider_offset, skip_prefixes=NON_PAGE_PREFIXES):
+    for parts in iter_records(data, pos_sider_offset, 'SIDER'):
+        if len(parts) != 5 or parts[0].startswith(skip_prefixes):  # URL, Pages, Bandwidth, Entry, Exit
+            continue
+        yield normalize_url(parts[0].decode('utf-8')), parts[1:]
+
+# Parse POS_SIDER section
+def parse_pos_sider(data, pos_sider_offset):
+    url_data = []
+    for url, fields in iter_pos_sider(data, pos_sider_offset, skip_prefixes=()):
+        pages, bandwidth, entry, exit_ = map(int, fields)
+        url_data.append({
+            'url': url,
+            'pages': pages,
+            'bandwidth': bandwidth,
+            'entry': entry,
+            'exit': exit_
+        })
+    return url_data
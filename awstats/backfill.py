@@ -0,0 +1,220 @@
+import os
+import time
+import argparse
+import multiprocessing
+from datetime import datetime
+
+import ingest
+import runScripts
+import summary
+import urls
+from db import ensure_connection, get_cursor, get_database_connection
+from file_tracking import DIRECTORIES, collect_files, file_month, file_website
+from partitions import ensure_file_partitions
+from purge import purge_url_stats
+from rollups import create_rollup_tables
+
+# Resumable reprocessing of archived monthly AWStats files. Every (server, website, month) is one
+# unit of work, backed by one data file. Units are run largest file first with bounded
+# parallelism, the servers of a website and month one after another on the same worker. Each
+# finished unit is checkpointed in the backfill_units table under the backfill's name, so an
+# interrupted backfill picks up with the units that are not done yet.
+
+DEFAULT_BACKFILL_NAME = 'default'
+
+def create_checkpoint_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_units (
+            name VARCHAR(64) NOT NULL,
+            server_id INT NOT NULL,
+            filename VARCHAR(255) NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            size BIGINT NOT NULL,
+            seconds DOUBLE NOT NULL,
+            finished DATETIME NOT NULL,
+            PRIMARY KEY (name, server_id, filename)
+        )
+    """)
+
+# (server_id, filename) of the units finished by a backfill
+def load_done_units(cursor, name):
+    cursor.execute("SELECT server_id, filename FROM backfill_units WHERE name = %s AND status = 'done'", (name,))
+    return set(cursor.fetchall())
+
+def save_checkpoint(cursor, name, server_id, filename, status, size, seconds):
+    cursor.execute("""
+        INSERT INTO backfill_units (name, server_id, filename, status, size, seconds, finished)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE status = VALUES(status), size = VALUES(size),
+        seconds = VALUES(seconds), finished = VALUES(finished)
+    """, (name, server_id, filename, status, size, seconds, datetime.now().replace(microsecond=0)))
+
+# Build the queue of units still to do: (file_path, server_id, last_modified, size), largest first
+def build_queue(cursor, files, name, since, until):
+    done = load_done_units(cursor, name)
+    queue = []
+    for file_path, server_id, last_modified in files:
+        filename = os.path.basename(file_path)
+        month = file_month(filename)
+        # Not an awstatsMMYYYY.website.txt file, so there is no month to backfill
+        if month is None:
+            continue
+        if (since and month < since) or (until and month > until) or (server_id, filename) in done:
+            continue
+        queue.append((file_path, server_id, last_modified, os.path.getsize(file_path)))
+    queue.sort(key=lambda unit: unit[3], reverse=True)
+    return queue, len(done)
+
+# Group the units of the same website and month, one per server, so they run one after another
+# on the same worker: they all update the same rollup rows, and running them side by side makes
+# their transactions wait for (and deadlock on) each other's row locks. Largest group first.
+def group_units(queue):
+    groups = {}
+    for unit in queue:
+        groups.setdefault(os.path.basename(unit[0]), []).append(unit)
+    return sorted(groups.values(), key=lambda units: sum(unit[3] for unit in units), reverse=True)
+
+# Insert each website's valid URLs once, before the units are spread over the workers, so
+# workers do not race to insert the same URLs
+def insert_valid_urls(connection, queue, batch_size):
+    cursor = get_cursor(connection)
+    for website_name in {file_website(unit[0]) for unit in queue}:
+        if website_name not in urls.valid_pages_cache or website_name in urls.valid_urls_inserted:
+            continue
+        try:
+            website_id = urls.get_website_id(cursor, website_name)
+        except ValueError:
+            continue  # Created by summary during the backfill; its first urls unit inserts them
+        if website_id not in urls.website_url_ids_cache:
+            urls.website_url_ids_cache[website_id] = urls.load_website_url_ids(cursor, website_id)
+        url_ids = urls.website_url_ids_cache[website_id]
+        urls.insert_website_urls(cursor, url_ids, website_id, urls.valid_pages_cache[website_name], batch_size)
+        connection.commit()
+        urls.valid_urls_inserted.add(website_name)
+    cursor.close()
+
+# Replace the stats of one unit. The month's URL stats are purged first and then ingested
+# again; URLs are not removed, as other workers may be writing stats for them.
+def run_unit(connection, cursor, unit, name, script_names, batch_size):
+    file_path, server_id, last_modified, size = unit
+    filename = os.path.basename(file_path)
+    start = time.monotonic()
+    if 'urls' in script_names:
+        try:
+            website_id = urls.get_website_id(cursor, file_website(filename))
+            year, month = file_month(filename)
+            purge_url_stats(connection, cursor, website_id=website_id, server_id=server_id,
+                            year=year, month=month, remove_unused_urls=False)
+        except ValueError:
+            pass  # Nothing stored for a website that does not exist yet
+
+    scripts = [runScripts.AVAILABLE_SCRIPTS[script_name] for script_name in script_names]
+    results = ingest.process_file(connection, cursor, file_path, server_id, last_modified, scripts, False, batch_size, {})
+    status = 'failed' if 'failed' in results.values() else 'done'
+    save_checkpoint(cursor, name, server_id, filename, status, size, time.monotonic() - start)
+    connection.commit()
+    return unit, status
+
+# Cursor of each pool worker, kept across units so its prepared statements are reused
+worker_cursor = None
+
+def run_worker_units(job):
+    global worker_cursor
+    units, name, script_names, batch_size = job
+    results = []
+    for unit in units:
+        if ensure_connection(ingest.connection) or worker_cursor is None:
+            worker_cursor = get_cursor(ingest.connection)
+        results.append(run_unit(ingest.connection, worker_cursor, unit, name, script_names, batch_size))
+    return results
+
+def run_queue(queue, name, script_names, batch_size, jobs):
+    total_bytes = sum(unit[3] for unit in queue) or 1
+    done_bytes = 0
+    counts = {'done': 0, 'failed': 0}
+    start = time.monotonic()
+
+    def report(unit, status):
+        nonlocal done_bytes
+        done_bytes += unit[3]
+        counts[status] += 1
+        elapsed = time.monotonic() - start
+        # Units are ordered by size, so throughput in bytes gives a steady estimate
+        remaining = elapsed * (total_bytes - done_bytes) / done_bytes if done_bytes else 0
+        print(f"[{counts['done'] + counts['failed']}/{len(queue)}] {os.path.basename(unit[0])} {status}; "
+              f"{done_bytes / total_bytes:.0%} of bytes in {elapsed:.0f}s, about {remaining:.0f}s left.")
+
+    if jobs > 1:
+        jobs_args = [(units, name, script_names, batch_size) for units in group_units(queue)]
+        with multiprocessing.Pool(jobs, initializer=ingest.init_worker) as pool:
+            # chunksize 1 keeps the largest-first order across the workers
+            for results in pool.imap_unordered(run_worker_units, jobs_args, chunksize=1):
+                for unit, status in results:
+                    report(unit, status)
+    else:
+        cursor = get_cursor(ingest.connection)
+        for unit in queue:
+            if ensure_connection(ingest.connection):
+                cursor = get_cursor(ingest.connection)
+            report(*run_unit(ingest.connection, cursor, unit, name, script_names, batch_size))
+        cursor.close()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocess archived AWStats files, resuming an interrupted backfill.')
+    parser.add_argument('--name', type=str, default=DEFAULT_BACKFILL_NAME, help='Name of the backfill whose checkpoints are used')
+    parser.add_argument('--server', type=str, help='Specify the server location')
+    parser.add_argument('--website', type=str, help='Specify the website name')
+    parser.add_argument('--since', type=urls.year_month, help='First month to backfill (YYYY-MM)')
+    parser.add_argument('--until', type=urls.year_month, help='Last month to backfill (YYYY-MM)')
+    parser.add_argument('--script', nargs='+', default=list(runScripts.AVAILABLE_SCRIPTS), help='Specify script(s) to run')
+    parser.add_argument('--jobs', type=int, default=4, help='Number of units processed in parallel')
+    parser.add_argument('--batch-size', type=int, default=summary.DEFAULT_BATCH_SIZE, help='Number of rows per multi-row INSERT')
+    parser.add_argument('--fetch-workers', type=int, default=urls.FETCH_WORKERS, help='Number of wikis to fetch valid pages from concurrently')
+    parser.add_argument('--restart', action='store_true', help='Forget the checkpoints of this backfill and start over')
+    args = parser.parse_args()
+
+    script_names = [name for name in runScripts.AVAILABLE_SCRIPTS if name in args.script]
+    if not script_names:
+        print(f"No valid scripts in {args.script}.")
+        return
+
+    directories = DIRECTORIES
+    if args.server:
+        directories = [dir for dir in directories if args.server in dir]
+        if not directories:
+            print(f"No directory found for server '{args.server}'.")
+            return
+
+    connection = get_database_connection()
+    ingest.connection = connection
+    cursor = get_cursor(connection)
+    create_checkpoint_table(cursor)
+    create_rollup_tables(cursor)
+    if args.restart:
+        cursor.execute("DELETE FROM backfill_units WHERE name = %s", (args.name,))
+    connection.commit()
+
+    files = collect_files(directories, website=args.website)
+    queue, done = build_queue(cursor, files, args.name, args.since, args.until)
+    ensure_file_partitions(cursor, queue)
+    cursor.close()
+    print(f"Backfill '{args.name}': {done} units already done, {len(queue)} to do "
+          f"({sum(unit[3] for unit in queue) / 2 ** 20:.0f} MiB).")
+    if not queue:
+        connection.close()
+        return
+
+    # Load the valid pages and insert the valid URLs up front; pool workers inherit the caches
+    if 'urls' in script_names:
+        urls.prefetch_websites(queue, args.fetch_workers)
+        insert_valid_urls(connection, queue, args.batch_size)
+
+    counts = run_queue(queue, args.name, script_names, args.batch_size, args.jobs)
+    print(f"Backfill '{args.name}': {counts['done']} units done, {counts['failed']} failed.")
+    if counts['failed']:
+        print("Run the backfill again to retry the failed units.")
+    connection.close()
+
+if __name__ == "__main__":
+    main()
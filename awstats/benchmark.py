@@ -0,0 +1,297 @@
+import os
+import io
+import json
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import summary
+import urls
+from awstats_reader import open_data_file, parse_begin_map, iter_records, iter_pos_sider, parse_pos_sider, normalize_url
+from sqlite_backend import SQLiteConnection
+from title_index import TitleIndex
+
+# Benchmarks for the AWStats parsers and the summary/urls ingestion. Synthetic data files are
+# generated with a correct BEGIN_MAP, and ingestion runs against an in-memory database of the
+# embedded SQLite backend, so no MySQL server or MediaWiki API is needed. Each run is appended to
+# a JSON lines results file and compared with the previous run of the same parameters.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RESULTS_PATH = os.path.join(SCRIPT_DIR, 'benchmark_results.jsonl')
+
+# Slowdown (as a fraction of the previous median) reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+BENCHMARK_WEBSITE = 'bench.bahai.works'
+BENCHMARK_SERVER_ID = 1
+
+# Raw SIDER URLs that are not wiki pages, mixed into the generated files
+ASSET_URLS = ['/load.php', '/api.php', '/index.php', '/favicon.ico', '/robots.txt',
+              '/skins/common/shared.css', '/resources/assets/poweredby_mediawiki_88x31.png']
+
+# Build the raw SIDER URLs of a wiki; some titles are percent-encoded like real page links
+def generate_urls(count, rng):
+    page_urls = []
+    for i in range(count):
+        title = f"Page_{i}"
+        if i % 7 == 0:
+            title = f"Writings_of_%E2%80%98Abdu%27l-Bah%C3%A1/{i}"
+        elif i % 5 == 0:
+            title = f"Talk_about_{i}_(compilation)"
+        page_urls.append(f"/wiki/{title}")
+    rng.shuffle(page_urls)
+    images = [f"/images/{i % 16:x}/{i % 256:02x}/File_{i}.jpg" for i in range(count // 10)]
+    return page_urls, images + ASSET_URLS
+
+# Write a synthetic AWStats data file and return the titles of its wiki pages
+def generate_data_file(path, year, month, url_count, days, seed=0):
+    rng = random.Random(seed)
+    page_urls, other_urls = generate_urls(url_count, rng)
+
+    visits = [rng.randint(500, 5000) for _ in range(days)]
+    sections = []
+    sections.append(('GENERAL', [
+        f"LastLine {year}{month:02d}{days:02d}235959 1234567 0 0 0 0",
+        f"FirstTime {year}{month:02d}01000012",
+        f"LastTime {year}{month:02d}{days:02d}235959",
+        f"LastUpdate {year}{month:02d}{days:02d}235959 12345 0 12300 30 15",
+        f"TotalVisits {sum(visits)}",
+        f"TotalUnique {sum(visits) // 3}",
+        "MonthHostsKnown 0",
+        f"MonthHostsUnknown {sum(visits) // 2}",
+    ]))
+    sections.append(('TIME', [f"{hour} {rng.randint(1000, 9000)} {rng.randint(2000, 20000)} "
+                              f"{rng.randint(10 ** 6, 10 ** 8)} 0 0 0" for hour in range(24)]))
+    sections.append(('DAY', ["# Date - Pages - Hits - Bandwidth - Visits"] + [
+        f"{year}{month:02d}{day + 1:02d} {visits[day] * 4} {visits[day] * 11} {visits[day] * 90000} {visits[day]}"
+        for day in range(days)
+    ]))
+    # Page hits follow a long-tailed distribution, as on the real wikis
+    sider = []
+    for rank, url in enumerate(page_urls + other_urls, 1):
+        pages = max(1, int(100000 / rank ** 1.1))
+        sider.append(f"{url} {pages} {pages * 25000} {pages // 3} {pages // 4}")
+    rng.shuffle(sider)
+    sections.append(('SIDER', ["# URL - Pages - Bandwidth - Entry - Exit"] + sider))
+
+    # Offsets are written at a fixed width first and filled in once the section positions are known
+    def render(offsets):
+        header = ["AWSTATS DATA FILE 7.8 (build 20200416)",
+                  "# If you remove this file, all statistics for date 202405 will be lost/reset.",
+                  "",
+                  f"BEGIN_MAP {len(sections)}"]
+        header += [f"POS_{name} {offsets.get(name, 0):<20}" for name, _ in sections]
+        header += ["END_MAP", ""]
+        text = '\n'.join(header) + '\n'
+        positions = {}
+        for name, lines in sections:
+            positions[name] = len(text.encode('utf-8'))
+            text += '\n'.join([f"BEGIN_{name} {len(lines)}"] + lines + [f"END_{name}", ""]) + '\n'
+        return text, positions
+
+    _, offsets = render({})
+    text, _ = render(offsets)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    return {normalize_url(url) for url in page_urls}
+
+# Generate the data files of one website across consecutive months
+def generate_data_files(directory, months, url_count, days):
+    files = []
+    valid_pages = set()
+    for index in range(months):
+        year, month = 2024 + index // 12, index % 12 + 1
+        path = os.path.join(directory, f"awstats{month:02d}{year}.{BENCHMARK_WEBSITE}.txt")
+        valid_pages |= generate_data_file(path, year, month, url_count, days, seed=index)
+        files.append((path, BENCHMARK_SERVER_ID, datetime.fromtimestamp(os.stat(path).st_mtime).replace(microsecond=0)))
+    # A tenth of the linked titles no longer exist on the wiki
+    valid_pages = set(sorted(valid_pages)[len(valid_pages) // 10:])
+    return files, valid_pages
+
+# In-memory database with the benchmark website in place
+def benchmark_connection():
+    connection = SQLiteConnection()
+    connection.connection.execute("INSERT INTO websites (name) VALUES (?)", (BENCHMARK_WEBSITE,))
+    return connection
+
+# Call func `repeat` times and return its timings in seconds and its last result
+def measure(func, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+# Run an ingestion with its output captured and make sure every file was processed, so a run
+# that failed part way is not recorded as a faster one
+def run_ingestion(name, run, db, count):
+    output = io.StringIO()
+    with redirect_stdout(output):
+        start = time.perf_counter()
+        results = run(db)
+        seconds = time.perf_counter() - start
+    if results.get('failed') or results.get('processed') != count:
+        errors = [line for line in output.getvalue().splitlines() if 'error' in line.lower()]
+        raise RuntimeError(f"{name}: expected {count} processed files, got {results}" +
+                           ''.join(f"\n  {line}" for line in errors[:20]))
+    return seconds
+
+# Time run(db) on a database prepared by setup(), returning the timings and queries of the last run
+def measure_ingestion(name, setup, run, repeat, count):
+    timings = []
+    queries = 0
+    for _ in range(repeat):
+        db = setup()
+        before = db.queries
+        timings.append(run_ingestion(name, run, db, count))
+        queries = db.queries - before
+    return timings, queries
+
+def summarize(timings, items):
+    median = statistics.median(timings)
+    return {
+        'min': min(timings),
+        'median': median,
+        'max': max(timings),
+        'items': items,
+        'items_per_second': items / median if median else None,
+    }
+
+# Fresh database and per-process caches for one ingestion run
+def ingestion_setup(valid_pages):
+    def setup():
+        summary.website_ids_cache.clear()
+        urls.website_ids_cache.clear()
+        urls.website_url_ids_cache.clear()
+        urls.reset_valid_pages()
+        urls.valid_pages_cache[BENCHMARK_WEBSITE] = TitleIndex(valid_pages)
+        urls.connection = benchmark_connection()
+        return urls.connection
+    return setup
+
+def run_benchmarks(files, valid_pages, repeat, batch_size):
+    results = {}
+    sample = files[0][0]
+    with open_data_file(sample) as data:
+        data = bytes(data)
+    positions = parse_begin_map(data)
+    decoded_urls = [parts[0].decode('utf-8') for parts in iter_records(data, positions['POS_SIDER'], 'SIDER')
+                    if len(parts) == 5]
+
+    timings, _ = measure(lambda: parse_begin_map(data), repeat * 10)
+    results['parse_begin_map'] = summarize(timings, 1)
+    timings, parsed = measure(lambda: summary.parse_sections(data, positions), repeat)
+    results['summary.parse_sections'] = summarize(timings, len(parsed['daily_data']))
+    timings, count = measure(lambda: sum(1 for _ in iter_pos_sider(data, positions['POS_SIDER'])), repeat)
+    results['iter_pos_sider'] = summarize(timings, count)
+    timings, records = measure(lambda: parse_pos_sider(data, positions['POS_SIDER']), repeat)
+    results['parse_pos_sider'] = summarize(timings, len(records))
+    timings, _ = measure(lambda: [normalize_url(url) for url in decoded_urls], repeat)
+    results['normalize_url'] = summarize(timings, len(decoded_urls))
+    titles = [normalize_url(url) for url in decoded_urls]
+    index = TitleIndex(valid_pages)
+    timings, _ = measure(lambda: index.contains_batch(titles), repeat)
+    results['title_index.contains_batch'] = summarize(timings, len(titles))
+
+    # End-to-end ingestion of every file, with stdout from the scripts captured
+    setup = ingestion_setup(valid_pages)
+    timings, queries = measure_ingestion('summary.ingest', setup, lambda db: summary.process_group(db, files, False, batch_size),
+                                         repeat, len(files))
+    results['summary.ingest'] = dict(summarize(timings, len(files)), queries=queries)
+    timings, queries = measure_ingestion('urls.ingest', setup, lambda db: urls.process_group(db, files, False, batch_size),
+                                         repeat, len(files))
+    results['urls.ingest'] = dict(summarize(timings, len(files)), queries=queries)
+
+    # Re-ingesting unchanged files incrementally should write nothing
+    def ingested():
+        db = setup()
+        run_ingestion('urls.ingest', lambda db: urls.process_group(db, files, False, batch_size), db, len(files))
+        return db
+    timings, queries = measure_ingestion('urls.ingest_incremental', ingested,
+                                         lambda db: urls.process_group(db, files, False, batch_size, True), repeat, len(files))
+    results['urls.ingest_incremental'] = dict(summarize(timings, len(files)), queries=queries)
+
+    # Re-ingesting unchanged summaries should only read the stored rows
+    def summarized():
+        db = setup()
+        run_ingestion('summary.ingest', lambda db: summary.process_group(db, files, False, batch_size), db, len(files))
+        return db
+    timings, queries = measure_ingestion('summary.reingest', summarized,
+                                         lambda db: summary.process_group(db, files, True, batch_size), repeat, len(files))
+    results['summary.reingest'] = dict(summarize(timings, len(files)), queries=queries)
+    return results
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Load the last saved run with the same parameters
+def load_previous_run(results_path, params):
+    previous = None
+    if os.path.exists(results_path):
+        with open(results_path) as file:
+            for line in file:
+                run = json.loads(line)
+                if run.get('params') == params:
+                    previous = run
+    return previous
+
+def print_results(results, previous):
+    print(f"{'benchmark':<26} {'median ms':>10} {'items/s':>12} {'change':>8}")
+    for name, result in results.items():
+        change = ''
+        if previous and name in previous['results']:
+            before = previous['results'][name]['median']
+            ratio = result['median'] / before - 1 if before else 0
+            change = f"{ratio:+.0%}"
+            if ratio > REGRESSION_THRESHOLD:
+                change += ' REGRESSION'
+        rate = f"{result['items_per_second']:.0f}" if result['items_per_second'] else ''
+        print(f"{name:<26} {result['median'] * 1000:>10.2f} {rate:>12} {change:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AWStats parsers and ingestion on synthetic data.')
+    parser.add_argument('--urls', type=int, default=20000, help='Number of wiki page URLs per data file')
+    parser.add_argument('--days', type=int, default=31, help='Number of days per data file')
+    parser.add_argument('--months', type=int, default=3, help='Number of monthly data files to ingest')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs per benchmark')
+    parser.add_argument('--batch-size', type=int, default=summary.DEFAULT_BATCH_SIZE, help='Rows per multi-row INSERT')
+    parser.add_argument('--results', type=str, default=DEFAULT_RESULTS_PATH, help='JSON lines file the results are appended to')
+    parser.add_argument('--no-save', action='store_true', help='Do not append the results to the results file')
+    args = parser.parse_args()
+
+    params = {'urls': args.urls, 'days': args.days, 'months': args.months, 'batch_size': args.batch_size}
+    with tempfile.TemporaryDirectory(prefix='awstats-bench-') as directory:
+        files, valid_pages = generate_data_files(directory, args.months, args.urls, args.days)
+        results = run_benchmarks(files, valid_pages, args.repeat, args.batch_size)
+
+    previous = load_previous_run(args.results, params)
+    print_results(results, previous)
+    if previous:
+        print(f"Compared with {previous['version']} run at {previous['timestamp']}.")
+
+    if not args.no_save:
+        run = {
+            'timestamp': datetime.now().replace(microsecond=0).isoformat(),
+            'version': git_version(),
+            'python': platform.python_version(),
+            'params': params,
+            'results': results,
+        }
+        with open(args.results, 'a') as file:
+            file.write(json.dumps(run) + '\n')
+        print(f"Results appended to {args.results}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+
+from rollups import add_staged_deltas
+
+# Bulk-load path for full rebuilds. Parsed SIDER records are streamed to a tab-separated
+# staging file instead of being upserted row by row, loaded with LOAD DATA LOCAL INFILE into
+# a temporary table, and merged into website_url and website_url_stats with a few set-based
+# INSERT ... SELECT statements. The connection must be opened with allow_local_infile=True
+# and the server must have local_infile enabled.
+
+STAGING_TABLE = 'website_url_stats_staging'
+
+class StagingFile:
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='awstats-staging-', suffix='.tsv')
+        self.file = os.fdopen(fd, 'w', encoding='utf-8', newline='\n')
+        self.rows = 0
+        # file_tracking rows written once the staged data is merged
+        self.tracking = []
+
+    # Stage one record; titles never contain tabs or newlines
+    def write(self, website_id, server_id, year, month, url, hits, entry_count, exit_count):
+        self.file.write(f"{website_id}\t{server_id}\t{year}\t{month}\t{url}\t{hits}\t{entry_count}\t{exit_count}\n")
+        self.rows += 1
+
+    # Remember the current end of the staging file so a failed file's records can be dropped
+    def checkpoint(self):
+        self.file.flush()
+        return self.file.tell(), self.rows
+
+    def rewind(self, checkpoint):
+        position, self.rows = checkpoint
+        self.file.seek(position)
+        self.file.truncate()
+
+    def track(self, filename, server_id, last_modified):
+        self.tracking.append((filename, server_id, last_modified))
+
+    # Load the staged records and merge them into website_url and website_url_stats
+    def merge(self, cursor, script_name, update_file_tracking):
+        self.file.flush()
+        if self.rows:
+            # Copy column types and collations from the real tables so the join can use their indexes
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {STAGING_TABLE}")
+            cursor.execute(f"""
+                CREATE TEMPORARY TABLE {STAGING_TABLE} AS
+                SELECT wu.website_id, ws.server_id, ws.year, ws.month, wu.url, ws.hits, ws.entry_count, ws.exit_count
+                FROM website_url wu INNER JOIN website_url_stats ws ON ws.website_url_id = wu.id
+                LIMIT 0
+            """)
+            cursor.execute(f"""
+                LOAD DATA LOCAL INFILE %s INTO TABLE {STAGING_TABLE}
+                CHARACTER SET utf8mb4
+                FIELDS TERMINATED BY '\\t' ESCAPED BY ''
+                LINES TERMINATED BY '\\n'
+                (website_id, server_id, year, month, url, hits, entry_count, exit_count)
+            """, (self.path,))
+            cursor.execute(f"ALTER TABLE {STAGING_TABLE} ADD INDEX (website_id, url)")
+            cursor.execute(f"""
+                INSERT IGNORE INTO website_url (website_id, url)
+                SELECT DISTINCT website_id, url FROM {STAGING_TABLE}
+            """)
+            cursor.execute(f"""
+                INSERT INTO website_url_stats (website_url_id, server_id, year, month, hits, entry_count, exit_count)
+                SELECT wu.id, s.server_id, s.year, s.month, SUM(s.hits), SUM(s.entry_count), SUM(s.exit_count)
+                FROM {STAGING_TABLE} s
+                INNER JOIN website_url wu ON wu.website_id = s.website_id AND wu.url = s.url
+                GROUP BY wu.id, s.server_id, s.year, s.month
+                ON DUPLICATE KEY UPDATE
+                hits = hits + VALUES(hits),
+                entry_count = entry_count + VALUES(entry_count),
+                exit_count = exit_count + VALUES(exit_count)
+            """)
+            add_staged_deltas(cursor, STAGING_TABLE)
+            cursor.execute(f"DROP TEMPORARY TABLE {STAGING_TABLE}")
+        for filename, server_id, last_modified in self.tracking:
+            update_file_tracking(cursor, filename, server_id, last_modified, script_name)
+        print(f"Bulk loaded {self.rows} staged URL stats from {len(self.tracking)} files.")
+
+    def close(self):
+        self.file.close()
+        os.unlink(self.path)
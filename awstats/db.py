@@ -0,0 +1,157 @@
+import os
+import threading
+
+import mysql.connector
+from mysql.connector import pooling
+from dotenv import load_dotenv
+
+from sqlite_backend import SQLiteConnection
+
+# Shared database layer for the AWStats scripts: connections come from a per-process pool,
+# single-row statements that run once or more per file are sent as server-side prepared
+# statements, and dropped connections are re-established between files. With DB_BACKEND=sqlite
+# the scripts write to an embedded SQLite database file instead of the MySQL server.
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Database credentials from .env
+db_host = os.getenv('DB_HOST')
+db_user = os.getenv('DB_USER')
+db_password = os.getenv('DB_PASSWORD')
+db_name = os.getenv('DB_NAME')
+
+# Storage backend: 'mysql', or 'sqlite' for the database file at DB_SQLITE_PATH
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql')
+SQLITE_PATH = os.getenv('DB_SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'awstats.sqlite'))
+
+# Connections per pool. MySQLConnectionPool opens all of them up front, and every process holds
+# one connection at a time, so more than one only keeps idle connections open on the server
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '1'))
+
+# Reconnect attempts and seconds between them
+RECONNECT_ATTEMPTS = 3
+RECONNECT_DELAY = 5
+
+# Most distinct statements kept prepared per cursor; others are sent as plain text
+PREPARED_STATEMENTS = 64
+
+# Statements the binary protocol cannot run
+UNPREPARABLE = ('LOAD', 'CREATE', 'ALTER', 'DROP', 'TRUNCATE')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Forked worker processes must not share the parent's pooled sockets
+def _reset_pools():
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_pools)
+
+# Database connection from the process's pool, opened on first use. Connections that allow
+# LOAD DATA LOCAL INFILE come from a pool of their own.
+def get_database_connection(allow_local_infile=False):
+    if DB_BACKEND == 'sqlite':
+        return SQLiteConnection(SQLITE_PATH)
+    with _pools_lock:
+        if allow_local_infile not in _pools:
+            _pools[allow_local_infile] = pooling.MySQLConnectionPool(
+                pool_name=f"awstats-{os.getpid()}-{int(allow_local_infile)}",
+                pool_size=POOL_SIZE,
+                host=db_host,
+                user=db_user,
+                password=db_password,
+                database=db_name,
+                allow_local_infile=allow_local_infile
+            )
+        pool = _pools[allow_local_infile]
+    return pool.get_connection()
+
+# Send rows in chunks; executemany rewrites each chunk into a single multi-row INSERT
+def execute_batched(cursor, query, rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        cursor.executemany(query, rows[start:start + batch_size])
+
+# Re-establish a connection that was dropped (server restart, wait_timeout on a long run).
+# Returns True if it had to, as prepared statements and temporary tables are then gone.
+def ensure_connection(connection):
+    if connection.is_connected():
+        return False
+    print("Database connection lost, reconnecting...")
+    connection.reconnect(attempts=RECONNECT_ATTEMPTS, delay=RECONNECT_DELAY)
+    return True
+
+# Roll back a failed file; a broken connection has nothing left to roll back
+def rollback(connection):
+    try:
+        connection.rollback()
+    except mysql.connector.Error as e:
+        print(f"Rollback failed: {e}")
+
+# Cursor that sends parameterized statements through one prepared cursor per distinct statement,
+# so the server parses each of them once per connection. Multi-row batches stay on the plain
+# cursor, whose executemany rewrites them into a single INSERT; a prepared executemany would
+# send one round trip per row.
+class StatementCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.plain = connection.cursor()
+        self.prepared = {}
+        self.rows = None
+        self.last = self.plain
+
+    def execute(self, query, params=()):
+        if query in self.prepared or (params and len(self.prepared) < PREPARED_STATEMENTS):
+            if not query.lstrip().upper().startswith(UNPREPARABLE):
+                return self.execute_prepared(query, params)
+        self.rows = None
+        self.last = self.plain
+        return self.plain.execute(query, params)
+
+    def execute_prepared(self, query, params):
+        cursor = self.prepared.get(query)
+        if cursor is None:
+            cursor = self.prepared[query] = self.connection.cursor(prepared=True)
+        cursor.execute(query, params)
+        # Prepared cursors are unbuffered; read the rows now so the next statement can run
+        self.rows = list(cursor.fetchall()) if cursor.description else None
+        self.last = cursor
+
+    def executemany(self, query, rows):
+        self.rows = None
+        self.last = self.plain
+        return self.plain.executemany(query, rows)
+
+    def fetchone(self):
+        if self.rows is None:
+            return self.plain.fetchone()
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        if self.rows is None:
+            return self.plain.fetchall()
+        rows, self.rows = self.rows, []
+        return rows
+
+    @property
+    def lastrowid(self):
+        return self.last.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.last.rowcount
+
+    @property
+    def description(self):
+        return self.last.description
+
+    def close(self):
+        for cursor in self.prepared.values():
+            cursor.close()
+        self.prepared.clear()
+        self.plain.close()
+
+def get_cursor(connection):
+    return StatementCursor(connection)
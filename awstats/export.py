@@ -0,0 +1,98 @@
+import os
+import csv
+import time
+import argparse
+
+from db import get_cursor, get_database_connection
+from urls import year_month
+
+# Columnar export of the stats for offline analysis. Each dataset is written one month at a
+# time, with website names and URLs resolved, as Hive-style partitioned files:
+#   <output>/<dataset>/year=YYYY/month=MM/part-0.parquet
+# which pyarrow, pandas, DuckDB or Spark read as one table, pruned by year and month. The export
+# reads from whichever backend DB_BACKEND selects, so a local SQLite database can be exported the
+# same way as the MySQL server. Parquet needs pyarrow; CSV files can be written without it.
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DATASETS = {
+    'url_stats': ('website_url_stats', """
+        SELECT w.name, wu.url, ws.server_id, ws.year, ws.month, ws.hits, ws.entry_count, ws.exit_count
+        FROM website_url_stats ws
+        INNER JOIN website_url wu ON wu.id = ws.website_url_id
+        INNER JOIN websites w ON w.id = wu.website_id
+        WHERE ws.year = %s AND ws.month = %s
+    """, ('website', 'url', 'server_id', 'year', 'month', 'hits', 'entry_count', 'exit_count')),
+    'summary': ('summary', """
+        SELECT w.name, s.server_id, s.year, s.month, s.day, s.unique_visitors, s.number_of_visits,
+        s.pages, s.hits, s.bandwidth
+        FROM summary s
+        INNER JOIN websites w ON w.id = s.website_id
+        WHERE s.year = %s AND s.month = %s
+    """, ('website', 'server_id', 'year', 'month', 'day', 'unique_visitors', 'number_of_visits',
+          'pages', 'hits', 'bandwidth')),
+}
+
+def write_parquet(path, columns, rows):
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    table = pyarrow.table({name: list(column) for name, column in zip(columns, values)})
+    pyarrow.parquet.write_table(table, path, compression='zstd')
+
+def write_csv(path, columns, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+WRITERS = {'parquet': write_parquet, 'csv': write_csv}
+
+# Months stored in a table, oldest first, between since and until when given
+def stored_months(cursor, table, since=None, until=None):
+    cursor.execute(f"SELECT DISTINCT year, month FROM {table} ORDER BY year, month")
+    return [(year, month) for year, month in cursor.fetchall()
+            if (not since or (year, month) >= since) and (not until or (year, month) <= until)]
+
+# Write one month of a dataset, replacing an earlier export of it
+def export_month(cursor, output, dataset, year, month, file_format):
+    table, query, columns = DATASETS[dataset]
+    cursor.execute(query, (year, month))
+    rows = cursor.fetchall()
+    directory = os.path.join(output, dataset, f"year={year}", f"month={month:02d}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-0.{file_format}")
+    temp_path = f"{path}.tmp-{os.getpid()}"
+    WRITERS[file_format](temp_path, columns, rows)
+    os.replace(temp_path, path)
+    return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the stats as columnar files, one per month.')
+    parser.add_argument('--output', type=str, required=True, help='Directory to write the datasets to')
+    parser.add_argument('--dataset', nargs='+', choices=list(DATASETS), default=list(DATASETS), help='Datasets to export')
+    parser.add_argument('--since', type=year_month, help='First month to export (YYYY-MM)')
+    parser.add_argument('--until', type=year_month, help='Last month to export (YYYY-MM)')
+    parser.add_argument('--format', choices=list(WRITERS), default='parquet', help='File format')
+    args = parser.parse_args()
+
+    if args.format == 'parquet' and pyarrow is None:
+        print("pyarrow is required to write Parquet files; install it or use --format csv.")
+        return
+
+    connection = get_database_connection()
+    cursor = get_cursor(connection)
+    for dataset in args.dataset:
+        start = time.monotonic()
+        months = stored_months(cursor, DATASETS[dataset][0], args.since, args.until)
+        rows = 0
+        for year, month in months:
+            rows += export_month(cursor, args.output, dataset, year, month, args.format)
+        print(f"Exported {rows} {dataset} rows in {len(months)} months in {time.monotonic() - start:.1f}s.")
+    cursor.close()
+    connection.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+from datetime import datetime
+
+# The AWStats data files of every server and the tracking of which of them each script has
+# already processed. The file_tracking rows of a (server_id, script_name) pair are loaded with
+# one query and compared in memory against a directory listing whose stat results come from
+# os.scandir.
+
+# Directories the AWStats files of each server are kept in, with the server's id
+SERVER_IDS = {
+    '/var/lib/awstats': 1,
+    '/home/private/server_stats/frankfurt': 2,
+    '/home/private/server_stats/saopaulo': 4,
+    '/home/private/server_stats/singapore': 3
+}
+
+DIRECTORIES = list(SERVER_IDS)
+
+# Map directories to server IDs
+def get_server_id(directory):
+    return SERVER_IDS.get(directory)
+
+# Website name of an awstatsMMYYYY.website.txt file
+def file_website(file_path):
+    return '.'.join(os.path.basename(file_path).split('.')[1:-1])
+
+# (year, month) of an awstatsMMYYYY.website.txt file, or None for other file names
+def file_month(file_path):
+    filename = os.path.basename(file_path)
+    if filename.startswith('awstats') and filename[7:13].isdigit():
+        return int(filename[9:13]), int(filename[7:9])
+    return None
+
+# Modification time as stored in file_tracking.last_modified
+def file_last_modified(stat_result):
+    return datetime.fromtimestamp(stat_result.st_mtime).replace(microsecond=0)
+
+# List (file_path, last_modified) for every AWStats data file in a directory
+def scan_directory(directory):
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt') and 'awstats' in entry.name and entry.is_file():
+                files.append((entry.path, file_last_modified(entry.stat())))
+    return files
+
+# Load the last_modified of every file tracked for a server and script
+def load_file_tracking(cursor, server_id, script_name):
+    cursor.execute("""
+        SELECT filename, last_modified FROM file_tracking
+        WHERE server_id = %s AND script_name = %s
+    """, (server_id, script_name))
+    return dict(cursor.fetchall())
+
+# Keep the (file_path, server_id, last_modified) entries whose file changed since it was last
+# processed by the script, loading the tracking rows of each server once
+def filter_unprocessed(cursor, files, script_name, force):
+    if force:
+        return list(files)  # Bypass the processing check if force is True
+    tracking = {}
+    pending = []
+    for file_path, server_id, last_modified in files:
+        if server_id not in tracking:
+            tracking[server_id] = load_file_tracking(cursor, server_id, script_name)
+        if tracking[server_id].get(os.path.basename(file_path)) != last_modified:
+            pending.append((file_path, server_id, last_modified))
+    return pending
+
+# Update the file_tracking table
+def update_file_tracking(cursor, filename, server_id, last_modified, script_name):
+    cursor.execute("""
+        INSERT INTO file_tracking (filename, server_id, last_modified, processed_date, script_name)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE last_modified = VALUES(last_modified), processed_date = VALUES(processed_date)
+    """, (filename, server_id, last_modified, datetime.now().replace(microsecond=0), script_name))
+
+# Forget that a script processed the awstatsMMYYYY.website.txt files of a website, server and
+# month (None for any), so the next run ingests them again
+def forget_file_tracking(cursor, script_name, website_name=None, server_id=None, year=None, month=None):
+    website_pattern = '%'
+    if website_name is not None:
+        website_pattern = ''.join('|' + char if char in '|%_' else char for char in website_name)
+    month_pattern = f"{month:02d}{year:04d}" if year is not None else '______'
+    query = "DELETE FROM file_tracking WHERE script_name = %s AND filename LIKE %s ESCAPE '|'"
+    params = [script_name, f"awstats{month_pattern}.{website_pattern}.txt"]
+    if server_id is not None:
+        query += " AND server_id = %s"
+        params.append(server_id)
+    cursor.execute(query, params)
+    return cursor.rowcount
+
+# List (file_path, server_id, last_modified) for every AWStats file to consider, optionally
+# only those of one website or (year, month)
+def collect_files(directories, file=None, website=None, month=None):
+    files = []
+    for directory in directories:
+        server_id = get_server_id(directory)
+        if server_id is None:
+            print(f"Server ID not found for directory '{directory}'.")
+            continue
+
+        if file:
+            file_path = os.path.join(directory, file)
+            if os.path.exists(file_path):
+                files.append((file_path, server_id, file_last_modified(os.stat(file_path))))
+            else:
+                print(f"File '{file}' not found in directory '{directory}'.")
+        else:
+            for file_path, last_modified in scan_directory(directory):
+                if website and file_website(file_path) != website:
+                    continue
+                files.append((file_path, server_id, last_modified))
+    if month:
+        files = [entry for entry in files if file_month(entry[0]) == month]
+    return files
+
+# Keep each website's files in one job so workers share its caches and never race on its rows
+def group_files_by_website(files):
+    groups = {}
+    for entry in files:
+        groups.setdefault(file_website(entry[0]), []).append(entry)
+    return list(groups.values())
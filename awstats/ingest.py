@@ -0,0 +1,100 @@
+import os
+import importlib
+import multiprocessing
+
+import metrics
+from awstats_reader import open_data_file, parse_begin_map
+from db import ensure_connection, get_cursor, get_database_connection, rollback
+
+# Ingestion shared by the processing scripts: a data file is opened and parsed once and its
+# sections handed to every script that still has to ingest it, and groups of files are spread
+# over a pool of worker processes, each with a connection of its own. Scripts are the modules
+# named by their SCRIPT_NAME; each provides SECTIONS, parse_sections and ingest_file.
+
+def load_script(name):
+    return importlib.import_module(name)
+
+def process_file(connection, cursor, file_path, server_id, last_modified, scripts, force, batch_size, options):
+    # Open and parse the file once, then hand the parsed sections to every script that needs it
+    filename = os.path.basename(file_path)
+    results = {}
+
+    try:
+        with open_data_file(file_path) as data:
+            positions = parse_begin_map(data)
+
+            # Commit each script's work separately so one failing script does not undo the others.
+            # Sections may be streamed from the mapped file, so ingest while it is still open.
+            for script in scripts:
+                with metrics.file_record(script.SCRIPT_NAME, file_path, server_id) as record:
+                    try:
+                        parsed = script.parse_sections(data, positions)
+                        results[script.SCRIPT_NAME] = script.ingest_file(
+                            cursor, filename, server_id, last_modified, parsed, force, batch_size,
+                            **options.get(script.SCRIPT_NAME, {}))
+                        with metrics.timed('commit'):
+                            connection.commit()
+                    except Exception as e:
+                        rollback(connection)
+                        if hasattr(script, 'discard_uncommitted_state'):
+                            script.discard_uncommitted_state()
+                        print(f"Error processing file {filename} with {script.SCRIPT_NAME}: {e}")
+                        results[script.SCRIPT_NAME] = 'failed'
+                    record['status'] = results[script.SCRIPT_NAME]
+    except Exception as e:
+        # Renamed or removed since it was listed, or not an AWStats file
+        print(f"Error reading file {filename}: {e}")
+        for script in scripts:
+            results.setdefault(script.SCRIPT_NAME, 'failed')
+
+    return results
+
+# Process (file_path, server_id, last_modified, script_names) entries with one cursor and count
+# the outcomes of each script
+def process_group(connection, files, script_names, force, batch_size, options):
+    totals = {name: {'processed': 0, 'skipped': 0, 'failed': 0} for name in script_names}
+    cursor = metrics.CountingCursor(get_cursor(connection))
+    for file_path, server_id, last_modified, pending_names in files:
+        # A reconnected session has lost its prepared statements
+        if ensure_connection(connection):
+            cursor = metrics.CountingCursor(get_cursor(connection))
+        scripts = [load_script(name) for name in pending_names]
+        results = process_file(connection, cursor, file_path, server_id, last_modified, scripts, force, batch_size, options)
+        for name, status in results.items():
+            totals[name][status] += 1
+    cursor.close()
+    return totals
+
+# Connection owned by each pool worker process
+connection = None
+
+def init_worker(allow_local_infile=False):
+    global connection
+    connection = get_database_connection(allow_local_infile)
+    metrics.reset()
+
+def run_worker_group(job):
+    process, files, args = job
+    # Send the worker's file metrics back with the results
+    return process(connection, files, *args), metrics.drain()
+
+# Add the (possibly per-script) outcome counts of a group to the totals
+def merge_counts(totals, counts):
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            merge_counts(totals.setdefault(key, {}), value)
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+# Run process(connection, files, *args) for every group, serially on the given connection or
+# across a pool of worker processes, and merge the outcome counts into totals
+def run_groups(connection, groups, process, args, jobs, totals, allow_local_infile=False):
+    if jobs > 1:
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(allow_local_infile,)) as pool:
+            for counts, records in pool.imap_unordered(run_worker_group, [(process, files, args) for files in groups]):
+                metrics.merge(records)
+                merge_counts(totals, counts)
+    else:
+        for files in groups:
+            merge_counts(totals, process(connection, files, *args))
+    return totals
@@ -0,0 +1,189 @@
+import os
+import re
+import json
+import time
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+
+from file_tracking import file_website
+
+# Per-run and per-file instrumentation for the processing scripts. Each file processed by a
+# script gets a record of its wall time per phase, rows written, rows left unchanged by change
+# detection, queries and the file's size; time outside a file (directory scan, tracking check,
+# prefetch) goes to the run record. Records are written as JSON lines and summed per script, server and
+# website into a Prometheus textfile-collector file.
+#
+# Rows written are the rows of the stats tables a file added, changed or deleted: rollup, tracking
+# and bookkeeping statements (SAVEPOINT, CREATE, file_tracking) are left out, so the count, the
+# rows per second and urls' --commit-rows threshold only follow the data itself.
+
+# Tables whose rows are counted as written
+DATA_TABLES = ('website_url_stats', 'summary', 'website_url')
+
+# Verb and table of a data-modifying statement
+WRITE_TARGET = re.compile(r'\s*(INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+(\w+)', re.IGNORECASE)
+
+# INSERT, REPLACE, UPDATE or DELETE for a statement that writes to one of the data tables
+def data_write(query):
+    match = WRITE_TARGET.match(query)
+    if match and match.group(2).lower() in DATA_TABLES:
+        return match.group(1).split()[0].upper()
+    return None
+
+def new_record():
+    return {'phases': {}, 'rows_written': 0, 'rows_unchanged': 0, 'queries': 0}
+
+run_record = new_record()
+run_started = time.time()
+records = []
+
+# Record of the file being processed, or None outside a file
+current = None
+
+# Start over, e.g. in a freshly forked pool worker or after each watch batch
+def reset():
+    global run_record, run_started, current
+    run_record = new_record()
+    run_started = time.time()
+    records.clear()
+    current = None
+
+def target():
+    return current if current is not None else run_record
+
+def add_time(phase, seconds):
+    phases = target()['phases']
+    phases[phase] = phases.get(phase, 0) + seconds
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start)
+
+# Track one file processed by a script; the caller sets record['status']
+@contextmanager
+def file_record(script_name, file_path, server_id):
+    global current
+    filename = os.path.basename(file_path)
+    current = dict(new_record(), script=script_name, server_id=server_id, file=filename,
+                   website=file_website(filename),
+                   file_bytes=os.path.getsize(file_path) if os.path.exists(file_path) else 0,
+                   status=None)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        record, current = current, None
+        record['wall'] = time.perf_counter() - start
+        # Whatever was not spent fetching, writing or committing went to reading and parsing
+        phases = record['phases']
+        phases['parse'] = max(0, record['wall'] - sum(phases.values()))
+        record['rows_per_second'] = record['rows_written'] / record['wall'] if record['wall'] else 0
+        records.append(record)
+
+# Cursor wrapper that counts queries and rows written and times them as db_write
+class CountingCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    # A single-row INSERT counts as one row; DELETE, UPDATE and INSERT ... SELECT count the rows
+    # they affected
+    def execute(self, query, params=()):
+        record = target()
+        record['queries'] += 1
+        with timed('db_write'):
+            result = self.cursor.execute(query, params)
+        verb = data_write(query)
+        if verb:
+            if verb in ('INSERT', 'REPLACE') and not re.search(r'\bSELECT\b', query, re.IGNORECASE):
+                record['rows_written'] += 1
+            elif self.cursor.rowcount > 0:
+                record['rows_written'] += self.cursor.rowcount
+        return result
+
+    # Rows sent, as MySQL counts an upsert that changed a row twice in its rowcount
+    def executemany(self, query, rows):
+        record = target()
+        record['queries'] += 1
+        with timed('db_write'):
+            result = self.cursor.executemany(query, rows)
+        if data_write(query):
+            record['rows_written'] += len(rows)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+# Hand the file records over (from a pool worker to the parent) and forget them
+def drain():
+    drained = list(records)
+    records.clear()
+    return drained
+
+def merge(worker_records):
+    records.extend(worker_records)
+
+# Append the run and file records to a JSON lines file
+def write_json_lines(path, scripts, totals):
+    run_id = datetime.fromtimestamp(run_started).replace(microsecond=0).isoformat()
+    with open(path, 'a') as file:
+        for record in records:
+            file.write(json.dumps(dict(record, type='file', run=run_id)) + '\n')
+        file.write(json.dumps(dict(run_record, type='run', run=run_id, scripts=list(scripts),
+                                   wall=time.time() - run_started, files=len(records), totals=totals)) + '\n')
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+# Write the metrics of the run in the Prometheus text format. The file is replaced atomically
+# so the node_exporter textfile collector never reads a partial file.
+def write_prometheus(path, scripts):
+    metrics = {}
+
+    def add(name, labels, value):
+        samples = metrics.setdefault(name, {})
+        samples[labels] = samples.get(labels, 0) + value
+
+    script_label = (('scripts', ','.join(scripts)),)
+    add('awstats_run_duration_seconds', script_label, time.time() - run_started)
+    add('awstats_run_last_timestamp_seconds', script_label, time.time())
+    for phase, seconds in run_record['phases'].items():
+        add('awstats_run_phase_seconds', script_label + (('phase', phase),), seconds)
+    add('awstats_run_queries', script_label, run_record['queries'])
+
+    for record in records:
+        labels = (('script', record['script']), ('server', record['server_id']), ('website', record['website']))
+        add('awstats_files', labels + (('status', record['status']),), 1)
+        add('awstats_file_seconds', labels, record['wall'])
+        for phase, seconds in record['phases'].items():
+            add('awstats_file_phase_seconds', labels + (('phase', phase),), seconds)
+        add('awstats_rows_written', labels, record['rows_written'])
+        add('awstats_rows_unchanged', labels, record['rows_unchanged'])
+        add('awstats_queries', labels, record['queries'])
+        add('awstats_file_bytes', labels, record['file_bytes'])
+
+    lines = []
+    for name, samples in metrics.items():
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples.items():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.awstats-metrics-')
+    with os.fdopen(fd, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+
+# Write whichever outputs were asked for
+def write(json_path, prometheus_path, scripts, totals):
+    if json_path:
+        write_json_lines(json_path, scripts, totals)
+    if prometheus_path:
+        write_prometheus(prometheus_path, scripts)
@@ -0,0 +1,249 @@
+import os
+import sqlite3
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from title_index import TitleIndex
+
+# Persistent cache of the valid (non-redirect, main namespace) page titles of each wiki.
+# A full allpages listing is only done when a website's cache is older than the TTL;
+# otherwise the cache is brought up to date from the wiki's create, delete and move
+# log events and its recent edits since the last sync, re-checking only the titles they
+# touched. Edits matter because turning a page into a redirect (or back) writes no log entry.
+
+load_dotenv()
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PAGE_CACHE_PATH = os.getenv('PAGE_CACHE_PATH', os.path.join(SCRIPT_DIR, 'valid_pages.sqlite'))
+PAGE_CACHE_TTL = timedelta(days=int(os.getenv('PAGE_CACHE_TTL_DAYS', '30')))
+
+# Log types whose events can add or remove a valid page
+LOG_TYPES = ('create', 'delete', 'move')
+
+# Recent change types that can make a page a redirect or a redirect a page. Wikis keep recent
+# changes for 90 days by default, well beyond PAGE_CACHE_TTL.
+RECENT_CHANGE_TYPES = 'edit|new'
+
+# Maximum number of titles per prop=info query for non-bot users
+TITLES_PER_QUERY = 50
+
+# Events this close to the last sync are read again to absorb clock skew
+SYNC_OVERLAP = timedelta(minutes=5)
+
+MEDIAWIKI_TIMESTAMP = '%Y-%m-%dT%H:%M:%SZ'
+
+# HTTP settings: (connect, read) timeout in seconds, retries with exponential backoff,
+# and how many wikis are fetched at the same time
+REQUEST_TIMEOUT = (10, int(os.getenv('API_READ_TIMEOUT', '60')))
+REQUEST_RETRIES = Retry(total=5, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=('GET',))
+FETCH_WORKERS = int(os.getenv('API_FETCH_WORKERS', '8'))
+
+_session = None
+_session_lock = threading.Lock()
+
+# Shared session so connections to each wiki are pooled and reused across requests and threads
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(max_retries=REQUEST_RETRIES, pool_maxsize=FETCH_WORKERS)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+# Forked worker processes must not reuse the parent's pooled sockets
+def _reset_session():
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_session)
+
+# Normalize a title the same way SIDER URLs are normalized
+def normalize_title(title):
+    return unquote(title.replace('_', ' '))
+
+# Run a query, following continuation, and yield each response
+def api_query(api_url, params):
+    params = dict(params, action='query', format='json')
+    session = get_session()
+    while True:
+        response = session.get(api_url, params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+
+        # Handle potential API errors
+        if 'error' in data:
+            raise Exception(f"MediaWiki API error: {data['error']['info']}")
+
+        yield data
+
+        if 'continue' in data:
+            params.update(data['continue'])
+        else:
+            break
+
+# Fetch valid content pages from MediaWiki API
+def get_valid_content_pages(api_url):
+    valid_pages = set()
+    params = {
+        'list': 'allpages',
+        'aplimit': 'max',
+        'redirects': '1',
+        'apfilterredir': 'nonredirects',
+    }
+    for data in api_query(api_url, params):
+        for page in data['query']['allpages']:
+            valid_pages.add(normalize_title(page['title']))
+    return valid_pages
+
+# Collect the titles touched by create/delete/move log events and main namespace edits since
+# a timestamp
+def get_changed_titles(api_url, since):
+    titles = set()
+    params = {
+        'list': 'recentchanges',
+        'rcnamespace': '0',
+        'rctype': RECENT_CHANGE_TYPES,
+        'rcstart': since.strftime(MEDIAWIKI_TIMESTAMP),
+        'rcdir': 'newer',
+        'rclimit': 'max',
+        'rcprop': 'title',
+    }
+    for data in api_query(api_url, params):
+        for change in data['query']['recentchanges']:
+            titles.add(change['title'])
+    for log_type in LOG_TYPES:
+        params = {
+            'list': 'logevents',
+            'letype': log_type,
+            'lestart': since.strftime(MEDIAWIKI_TIMESTAMP),
+            'ledir': 'newer',
+            'lelimit': 'max',
+            'leprop': 'title|details',
+        }
+        for data in api_query(api_url, params):
+            for event in data['query']['logevents']:
+                if 'title' in event:
+                    titles.add(event['title'])
+                target = event.get('params', {}).get('target_title')
+                if target:
+                    titles.add(target)
+    return titles
+
+# Check the current state of titles; returns (valid, invalid) sets of normalized titles
+def check_titles(api_url, titles):
+    valid, invalid = set(), set()
+    titles = sorted(titles)
+    for start in range(0, len(titles), TITLES_PER_QUERY):
+        chunk = titles[start:start + TITLES_PER_QUERY]
+        invalid.update(normalize_title(title) for title in chunk)
+        for data in api_query(api_url, {'titles': '|'.join(chunk), 'prop': 'info'}):
+            for page in data['query'].get('pages', {}).values():
+                if page.get('ns') == 0 and 'missing' not in page and 'redirect' not in page:
+                    valid.add(normalize_title(page['title']))
+    return valid, invalid - valid
+
+# Open the cache database, creating its tables on first use
+def get_cache_connection(path=PAGE_CACHE_PATH):
+    cache = sqlite3.connect(path, timeout=60)
+    cache.executescript("""
+        CREATE TABLE IF NOT EXISTS websites (
+            name TEXT PRIMARY KEY,
+            full_refresh REAL NOT NULL,
+            last_sync TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pages (
+            website TEXT NOT NULL,
+            title TEXT NOT NULL,
+            PRIMARY KEY (website, title)
+        ) WITHOUT ROWID;
+    """)
+    return cache
+
+# Read the cached titles of a website into a title index, without building a set first
+def load_cached_pages(cache, website_name):
+    rows = cache.execute("SELECT title FROM pages WHERE website = ?", (website_name,))
+    return TitleIndex(title for (title,) in rows)
+
+# Return the TitleIndex of the valid page titles of a website, refreshing the on-disk cache as needed
+def get_valid_pages(website_name, api_url=None, cache_path=PAGE_CACHE_PATH, ttl=PAGE_CACHE_TTL):
+    api_url = api_url or f'https://{website_name}/api.php'
+    sync_time = datetime.now(timezone.utc)
+    cache = get_cache_connection(cache_path)
+    try:
+        row = cache.execute("SELECT full_refresh, last_sync FROM websites WHERE name = ?",
+                            (website_name,)).fetchone()
+        if row and time.time() - row[0] < ttl.total_seconds():
+            try:
+                return refresh_incrementally(cache, website_name, api_url,
+                                             datetime.fromisoformat(row[1]), sync_time)
+            except Exception as e:
+                print(f"Incremental page refresh failed for {website_name}, re-listing all pages: {e}")
+        return refresh_fully(cache, website_name, api_url, sync_time)
+    finally:
+        cache.close()
+
+# Replace a website's cached titles with a full allpages listing
+def refresh_fully(cache, website_name, api_url, sync_time):
+    print(f"Fetching valid content pages from MediaWiki API at {api_url}...")
+    valid_pages = get_valid_content_pages(api_url)
+    with cache:
+        cache.execute("DELETE FROM pages WHERE website = ?", (website_name,))
+        cache.executemany("INSERT OR IGNORE INTO pages (website, title) VALUES (?, ?)",
+                          ((website_name, title) for title in valid_pages))
+        cache.execute("INSERT OR REPLACE INTO websites (name, full_refresh, last_sync) VALUES (?, ?, ?)",
+                      (website_name, time.time(), sync_time.isoformat()))
+    return TitleIndex(valid_pages)
+
+# Apply the log events since the last sync to a website's cached titles
+def refresh_incrementally(cache, website_name, api_url, last_sync, sync_time):
+    changed = get_changed_titles(api_url, last_sync - SYNC_OVERLAP)
+    valid, invalid = check_titles(api_url, changed)
+    with cache:
+        cache.executemany("INSERT OR IGNORE INTO pages (website, title) VALUES (?, ?)",
+                          ((website_name, title) for title in valid))
+        cache.executemany("DELETE FROM pages WHERE website = ? AND title = ?",
+                          ((website_name, title) for title in invalid))
+        cache.execute("UPDATE websites SET last_sync = ? WHERE name = ?",
+                      (sync_time.isoformat(), website_name))
+    print(f"Refreshed cached pages for {website_name}: {len(valid)} added or kept, {len(invalid)} removed.")
+    return load_cached_pages(cache, website_name)
+
+# Fetch the valid pages of several websites concurrently with bounded parallelism.
+# Returns a dict of website name to TitleIndex; websites that failed are left out.
+def prefetch_valid_pages(website_names, max_workers=FETCH_WORKERS, cache_path=PAGE_CACHE_PATH):
+    website_names = sorted(set(website_names))
+    if not website_names:
+        return {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(website_names)))) as executor:
+        futures = {name: executor.submit(get_valid_pages, name, cache_path=cache_path) for name in website_names}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                print(f"Error prefetching valid pages for {name}: {e}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh the cached valid page titles of wikis.')
+    parser.add_argument('--website', nargs='+', default=[], help='Websites whose cached pages are refreshed')
+    args = parser.parse_args()
+
+    for name, index in prefetch_valid_pages(args.website).items():
+        print(f"{name}: {len(index)} valid pages.")
+
+if __name__ == "__main__":
+    main()
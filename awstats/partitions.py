@@ -0,0 +1,206 @@
+import re
+import time
+import argparse
+from datetime import date
+
+from db import DB_BACKEND, get_cursor, get_database_connection
+from file_tracking import file_month
+
+# Partitioning of the per-month stats tables by (year, month). Every month gets a partition of
+# its own, named pYYYYMM, so month-scoped queries are pruned to a single partition and a whole
+# month can be emptied with TRUNCATE PARTITION instead of deleting its rows one by one.
+# Partitions are contiguous: the first one also takes anything older and pmax anything newer
+# than the last month, until ensure_month_partitions splits new months off them.
+#
+# ALTER TABLE commits the open transaction, so partitions are added before files are ingested
+# and never inside a file's transaction. The migration copies the whole table; run it while no
+# ingestion is running.
+
+PARTITIONED_TABLES = ('website_url_stats', 'summary')
+
+# Months partitioned beyond the current one
+DEFAULT_MONTHS_AHEAD = 2
+
+PARTITION_NAME = re.compile(r'p(\d{4})(\d{2})$')
+
+def partition_name(year, month):
+    return f"p{year:04d}{month:02d}"
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+def add_months(year, month, count):
+    year, month = divmod(year * 12 + month - 1 + count, 12)
+    return year, month + 1
+
+# (year, month) pairs from first to last, both included
+def month_range(first, last):
+    month = first
+    while month <= last:
+        yield month
+        month = next_month(*month)
+
+def partition_definitions(months):
+    return ', '.join(f"PARTITION {partition_name(*month)} VALUES LESS THAN ({next_month(*month)[0]}, {next_month(*month)[1]})"
+                     for month in months)
+
+# Print the statement instead of running it with dry_run
+def execute_ddl(cursor, statement, dry_run):
+    if dry_run:
+        print(statement + ';')
+        return
+    start = time.monotonic()
+    cursor.execute(statement)
+    print(f"{statement.split(' (')[0]}: done in {time.monotonic() - start:.1f}s.")
+
+# Months with a partition of their own, oldest first. Empty if the table is not partitioned
+# (or the backend has no partitions); None if it is partitioned some other way.
+def load_month_partitions(cursor, table):
+    if DB_BACKEND != 'mysql':
+        return []
+    cursor.execute("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """, (table,))
+    names = [row[0] for row in cursor.fetchall()]
+    if names and names[-1] != 'pmax':
+        return None
+    months = []
+    for name in names[:-1]:
+        match = PARTITION_NAME.match(name)
+        if not match:
+            return None
+        months.append((int(match.group(1)), int(match.group(2))))
+    return months
+
+# Year and month of each awstatsMMYYYY.website.txt file in a (file_path, ...) list
+def file_months(files):
+    return {file_month(entry[0]) for entry in files} - {None}
+
+# Give every month a partition of its own before rows for it are written: newer months are split
+# off pmax, older ones off the first partition. Does nothing on tables that are not partitioned.
+def ensure_month_partitions(cursor, table, months, dry_run=False):
+    if not months:
+        return 0
+    partitions = load_month_partitions(cursor, table)
+    if not partitions:
+        return 0
+    added = 0
+    newest = max(months)
+    if newest > partitions[-1]:
+        new = list(month_range(next_month(*partitions[-1]), newest))
+        execute_ddl(cursor, f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO ({partition_definitions(new)}, "
+                            f"PARTITION pmax VALUES LESS THAN (MAXVALUE, MAXVALUE))", dry_run)
+        added += len(new)
+    oldest = min(months)
+    if oldest < partitions[0]:
+        new = list(month_range(oldest, partitions[0]))
+        execute_ddl(cursor, f"ALTER TABLE {table} REORGANIZE PARTITION {partition_name(*partitions[0])} "
+                            f"INTO ({partition_definitions(new)})", dry_run)
+        added += len(new) - 1
+    return added
+
+# Partition the months of the listed files in every partitioned table
+def ensure_file_partitions(cursor, files, tables=PARTITIONED_TABLES):
+    months = file_months(files)
+    for table in tables:
+        added = ensure_month_partitions(cursor, table, months)
+        if added:
+            print(f"Added {added} month partitions to {table}.")
+
+# Empty one month of a table with TRUNCATE PARTITION. Returns False, leaving the rows to the
+# caller, when the month has no partition of its own or its partition also holds older months.
+def truncate_month(cursor, table, year, month):
+    partitions = load_month_partitions(cursor, table)
+    if not partitions or (year, month) not in partitions:
+        return False
+    name = partition_name(year, month)
+    if (year, month) == partitions[0]:
+        cursor.execute(f"SELECT 1 FROM {table} PARTITION ({name}) WHERE year < %s OR (year = %s AND month < %s) LIMIT 1",
+                       (year, year, month))
+        if cursor.fetchone():
+            return False
+    cursor.execute(f"ALTER TABLE {table} TRUNCATE PARTITION {name}")
+    return True
+
+# Reasons the table cannot be partitioned by (year, month), if any
+def migration_blockers(cursor, table):
+    blockers = []
+    # InnoDB does not support foreign keys on partitioned tables, in either direction
+    cursor.execute("""
+        SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE() AND (TABLE_NAME = %s OR REFERENCED_TABLE_NAME = %s)
+    """, (table, table))
+    for (name,) in cursor.fetchall():
+        blockers.append(f"foreign key {name}")
+    # Every unique key has to contain the partitioning columns
+    cursor.execute("""
+        SELECT INDEX_NAME, GROUP_CONCAT(COLUMN_NAME) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND NON_UNIQUE = 0
+        GROUP BY INDEX_NAME
+    """, (table,))
+    for name, columns in cursor.fetchall():
+        if not {'year', 'month'} <= set(columns.split(',')):
+            blockers.append(f"unique key {name} ({columns}) without year and month")
+    return blockers
+
+# Partition a table by month, from its oldest month to `ahead` months after the current one
+def migrate_table(cursor, table, ahead=DEFAULT_MONTHS_AHEAD, dry_run=False):
+    partitions = load_month_partitions(cursor, table)
+    if partitions is None or partitions:
+        print(f"{table} is already partitioned.")
+        return partitions is not None
+    blockers = migration_blockers(cursor, table)
+    if blockers:
+        print(f"Cannot partition {table}: {'; '.join(blockers)}.")
+        return False
+    today = date.today()
+    newest = add_months(today.year, today.month, ahead)
+    cursor.execute(f"SELECT MIN(year * 100 + month) FROM {table}")
+    oldest = cursor.fetchone()[0]
+    oldest = min(divmod(int(oldest), 100), newest) if oldest else (today.year, today.month)
+    months = list(month_range(oldest, newest))
+    print(f"Partitioning {table} into {len(months)} months from {oldest[0]}-{oldest[1]:02d}...")
+    execute_ddl(cursor, f"ALTER TABLE {table} PARTITION BY RANGE COLUMNS (year, month) ({partition_definitions(months)}, "
+                        f"PARTITION pmax VALUES LESS THAN (MAXVALUE, MAXVALUE))", dry_run)
+    return True
+
+def print_layout(cursor, table):
+    partitions = load_month_partitions(cursor, table)
+    if partitions is None:
+        print(f"{table}: partitioned, but not by month.")
+    elif not partitions:
+        print(f"{table}: not partitioned.")
+    else:
+        print(f"{table}: {len(partitions)} month partitions from {partitions[0][0]}-{partitions[0][1]:02d} "
+              f"to {partitions[-1][0]}-{partitions[-1][1]:02d}, plus pmax.")
+
+def main():
+    parser = argparse.ArgumentParser(description='Partition the stats tables by month and maintain their partitions.')
+    parser.add_argument('--migrate', action='store_true', help='Partition the tables that are not partitioned yet (copies each table)')
+    parser.add_argument('--ahead', type=int, default=DEFAULT_MONTHS_AHEAD, help='Months after the current one to add partitions for')
+    parser.add_argument('--table', nargs='+', default=list(PARTITIONED_TABLES), help='Tables to work on')
+    parser.add_argument('--dry-run', action='store_true', help='Print the ALTER TABLE statements instead of running them')
+    args = parser.parse_args()
+
+    if DB_BACKEND != 'mysql':
+        print(f"Partitioning needs the MySQL backend, not {DB_BACKEND}.")
+        return
+
+    connection = get_database_connection()
+    cursor = get_cursor(connection)
+
+    today = date.today()
+    for table in args.table:
+        if args.migrate:
+            migrate_table(cursor, table, args.ahead, args.dry_run)
+        # Partition the coming months ahead of the files that will be ingested for them
+        if ensure_month_partitions(cursor, table, {add_months(today.year, today.month, args.ahead)}, args.dry_run):
+            print(f"Added month partitions to {table} up to {args.ahead} months ahead.")
+        print_layout(cursor, table)
+    cursor.close()
+    connection.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import time
+
+from file_tracking import forget_file_tracking
+from partitions import truncate_month
+from rollups import clear_month_url_totals, remove_empty_url_totals, subtract_url_stats
+
+# Chunked purge of URL stats for the --force options. Instead of one multi-table DELETE ... JOIN
+# over everything selected, website_url ids are walked in primary-key order and each chunk's
+# stats and orphaned URLs are deleted by id, committing after every chunk so locks are only
+# held briefly and other readers are not stalled. A website's month only visits the URLs with
+# stats in that month, and a whole month of a partitioned table is emptied by truncating its
+# partition.
+#
+# The purged files' urls tracking rows are deleted in the first chunk's transaction, so once any
+# of their stats are gone for good the next run ingests them again, even if the re-ingest of a
+# forced rebuild never happens or fails.
+
+DEFAULT_PURGE_BATCH_SIZE = 1000
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 10
+
+# Yield the website_url ids to purge in ascending chunks. A website's ids are read once since
+# they are not contiguous; for one month only the ids with stats in it are read, which the
+# year and month conditions prune to the month's partition. Without a website the primary key
+# is paged through directly.
+def iter_url_id_chunks(cursor, website_id, batch_size, server_id=None, year=None, month=None):
+    if website_id is not None:
+        if year is not None:
+            query = """
+                SELECT DISTINCT ws.website_url_id FROM website_url_stats ws
+                INNER JOIN website_url wu ON wu.id = ws.website_url_id
+                WHERE wu.website_id = %s AND ws.year = %s AND ws.month = %s
+            """
+            params = [website_id, year, month]
+            if server_id is not None:
+                query += " AND ws.server_id = %s"
+                params.append(server_id)
+            cursor.execute(query + " ORDER BY ws.website_url_id", params)
+        else:
+            cursor.execute("SELECT id FROM website_url WHERE website_id = %s ORDER BY id", (website_id,))
+        ids = [row[0] for row in cursor.fetchall()]
+        for start in range(0, len(ids), batch_size):
+            yield ids[start:start + batch_size]
+        return
+    last_id = 0
+    while True:
+        cursor.execute("SELECT id FROM website_url WHERE id > %s ORDER BY id LIMIT %s", (last_id, batch_size))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+# Delete the website_url_stats rows matching the filters, then (unless remove_unused_urls is
+# False) the website_url rows left without stats, and forget the urls tracking of the files they
+# came from. With commit=False the caller's transaction is kept, e.g. inside a single file's
+# ingest. Returns (stats rows deleted, URLs deleted).
+def purge_url_stats(connection, cursor, website_id=None, server_id=None, year=None, month=None,
+                    batch_size=DEFAULT_PURGE_BATCH_SIZE, commit=True, remove_unused_urls=True):
+    conditions = []
+    params = []
+    if server_id is not None:
+        conditions.append("server_id = %s")
+        params.append(server_id)
+    if year is not None:
+        conditions.append("year = %s AND month = %s")
+        params.extend((year, month))
+    filters = ''.join(f" AND {condition}" for condition in conditions)
+
+    # The files of the purged stats have to be ingested again by urls
+    website_name = None
+    if website_id is not None:
+        cursor.execute("SELECT name FROM websites WHERE id = %s", (website_id,))
+        website_name = cursor.fetchone()[0]
+    forget_file_tracking(cursor, 'urls', website_name, server_id, year, month)
+
+    scanned = stats_deleted = urls_deleted = 0
+    started = last_report = time.monotonic()
+
+    # A whole month on a partitioned website_url_stats: truncate its partition (which commits)
+    # and take the month out of the rollups. The chunks then only remove the unused URLs.
+    truncated = False
+    if website_id is None and server_id is None and year is not None and commit:
+        cursor.execute("SELECT COUNT(*) FROM website_url_stats WHERE year = %s AND month = %s", (year, month))
+        month_rows = cursor.fetchone()[0]
+        if truncate_month(cursor, 'website_url_stats', year, month):
+            clear_month_url_totals(cursor, year, month)
+            connection.commit()
+            truncated = True
+            stats_deleted = month_rows
+            print(f"Truncated the {year}-{month:02d} partition of website_url_stats ({month_rows} rows).")
+
+    for ids in iter_url_id_chunks(cursor, website_id, batch_size, server_id, year, month):
+        if truncated and not remove_unused_urls:
+            break
+        placeholders = ', '.join(['%s'] * len(ids))
+        if not truncated:
+            subtract_url_stats(cursor, ids, filters, params)
+            cursor.execute(f"DELETE FROM website_url_stats WHERE website_url_id IN ({placeholders}){filters}",
+                           (*ids, *params))
+            stats_deleted += cursor.rowcount
+        if remove_unused_urls:
+            cursor.execute(f"""
+                DELETE FROM website_url WHERE id IN ({placeholders})
+                AND NOT EXISTS (SELECT 1 FROM website_url_stats ws WHERE ws.website_url_id = website_url.id)
+            """, ids)
+            urls_deleted += cursor.rowcount
+        remove_empty_url_totals(cursor, ids)
+        if commit:
+            connection.commit()
+        scanned += len(ids)
+        if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            print(f"Purge progress: {scanned} URLs scanned up to id {ids[-1]}, "
+                  f"{stats_deleted} stats rows and {urls_deleted} URLs deleted...")
+    if commit:
+        # Commits the tracking rows when there was nothing else to purge
+        connection.commit()
+        print(f"Purged {stats_deleted} stats rows and {urls_deleted} unused URLs "
+              f"({scanned} URLs scanned) in {time.monotonic() - started:.1f}s.")
+    return stats_deleted, urls_deleted
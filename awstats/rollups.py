@@ -0,0 +1,197 @@
+import argparse
+
+from db import execute_batched, get_cursor, get_database_connection
+
+# Cross-server rollups kept up to date during ingestion, so dashboards read one row instead of
+# aggregating every server and month:
+#   website_month_totals      one row per website and month: the summary totals of all servers
+#                             and the sum of its URL hits
+#   website_url_month_totals  one row per URL and month with the hits of all servers, indexed
+#                             so a website's top URLs for a month are a single index range scan
+# URL totals are changed by the same rows (or deltas) that are added to website_url_stats and
+# reduced by what the purge deletes. Summary rows are replaced rather than added to, so the
+# summary totals of a website and month are recomputed from its few summary rows instead.
+
+def create_rollup_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS website_month_totals (
+            website_id INT NOT NULL,
+            year INT NOT NULL,
+            month INT NOT NULL,
+            unique_visitors BIGINT NOT NULL DEFAULT 0,
+            number_of_visits BIGINT NOT NULL DEFAULT 0,
+            pages BIGINT NOT NULL DEFAULT 0,
+            hits BIGINT NOT NULL DEFAULT 0,
+            bandwidth BIGINT NOT NULL DEFAULT 0,
+            url_hits BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (website_id, year, month)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS website_url_month_totals (
+            website_url_id INT NOT NULL,
+            website_id INT NOT NULL,
+            year INT NOT NULL,
+            month INT NOT NULL,
+            hits BIGINT NOT NULL DEFAULT 0,
+            entry_count BIGINT NOT NULL DEFAULT 0,
+            exit_count BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (website_url_id, year, month),
+            INDEX top_urls (website_id, year, month, hits)
+        )
+    """)
+
+# Add (website_url_id, server_id, year, month, hits, entry, exit) rows, as written to
+# website_url_stats, to the URL and website totals. The totals are locked in key order, as the
+# purge does, so concurrent writers of the same website wait for each other instead of deadlocking.
+def add_url_deltas(cursor, website_id, rows, batch_size):
+    if not rows:
+        return
+    rows = sorted(rows, key=lambda row: (row[0], row[2], row[3]))
+    execute_batched(cursor, """
+        INSERT INTO website_url_month_totals (website_url_id, website_id, year, month, hits, entry_count, exit_count)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+        hits = hits + VALUES(hits),
+        entry_count = entry_count + VALUES(entry_count),
+        exit_count = exit_count + VALUES(exit_count)
+    """, [(website_url_id, website_id, year, month, hits, entry, exit_)
+          for website_url_id, server_id, year, month, hits, entry, exit_ in rows], batch_size)
+    url_hits = {}
+    for row in rows:
+        url_hits[row[2], row[3]] = url_hits.get((row[2], row[3]), 0) + row[4]
+    cursor.executemany("""
+        INSERT INTO website_month_totals (website_id, year, month, url_hits)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE url_hits = url_hits + VALUES(url_hits)
+    """, [(website_id, year, month, hits) for (year, month), hits in sorted(url_hits.items())])
+
+# Add the rows of a bulk-load staging table, as merged into website_url_stats
+def add_staged_deltas(cursor, staging_table):
+    cursor.execute(f"""
+        INSERT INTO website_url_month_totals (website_url_id, website_id, year, month, hits, entry_count, exit_count)
+        SELECT wu.id, wu.website_id, s.year, s.month, SUM(s.hits), SUM(s.entry_count), SUM(s.exit_count)
+        FROM {staging_table} s
+        INNER JOIN website_url wu ON wu.website_id = s.website_id AND wu.url = s.url
+        GROUP BY wu.id, wu.website_id, s.year, s.month
+        ON DUPLICATE KEY UPDATE
+        hits = hits + VALUES(hits),
+        entry_count = entry_count + VALUES(entry_count),
+        exit_count = exit_count + VALUES(exit_count)
+    """)
+    cursor.execute(f"""
+        INSERT INTO website_month_totals (website_id, year, month, url_hits)
+        SELECT website_id, year, month, SUM(hits) FROM {staging_table}
+        GROUP BY website_id, year, month
+        ON DUPLICATE KEY UPDATE url_hits = url_hits + VALUES(url_hits)
+    """)
+
+# Take the website_url_stats rows about to be purged (website_url_id IN ids plus the purge's
+# filters on server_id/year/month) out of the totals
+def subtract_url_stats(cursor, ids, filters, params):
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"""
+        INSERT INTO website_url_month_totals (website_url_id, website_id, year, month, hits, entry_count, exit_count)
+        SELECT ws.website_url_id, wu.website_id, ws.year, ws.month, -SUM(ws.hits), -SUM(ws.entry_count), -SUM(ws.exit_count)
+        FROM website_url_stats ws
+        INNER JOIN website_url wu ON wu.id = ws.website_url_id
+        WHERE ws.website_url_id IN ({placeholders}){filters}
+        GROUP BY ws.website_url_id, wu.website_id, ws.year, ws.month
+        ON DUPLICATE KEY UPDATE
+        hits = hits + VALUES(hits),
+        entry_count = entry_count + VALUES(entry_count),
+        exit_count = exit_count + VALUES(exit_count)
+    """, (*ids, *params))
+    cursor.execute(f"""
+        INSERT INTO website_month_totals (website_id, year, month, url_hits)
+        SELECT wu.website_id, ws.year, ws.month, -SUM(ws.hits)
+        FROM website_url_stats ws
+        INNER JOIN website_url wu ON wu.id = ws.website_url_id
+        WHERE ws.website_url_id IN ({placeholders}){filters}
+        GROUP BY wu.website_id, ws.year, ws.month
+        ON DUPLICATE KEY UPDATE url_hits = url_hits + VALUES(url_hits)
+    """, (*ids, *params))
+
+# Drop the URL totals of purged URLs that no longer have any stats
+def remove_empty_url_totals(cursor, ids):
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"""
+        DELETE FROM website_url_month_totals
+        WHERE website_url_id IN ({placeholders}) AND hits = 0 AND entry_count = 0 AND exit_count = 0
+    """, ids)
+
+# Take a whole month of URL stats, emptied at once by a partition truncate, out of the totals
+def clear_month_url_totals(cursor, year, month):
+    cursor.execute("DELETE FROM website_url_month_totals WHERE year = %s AND month = %s", (year, month))
+    cursor.execute("UPDATE website_month_totals SET url_hits = 0 WHERE year = %s AND month = %s", (year, month))
+
+# Recompute the summary totals of a website and month from its summary rows on every server.
+# The day 0 rows hold each server's unique visitors, the other days the daily counters.
+def refresh_website_month(cursor, website_id, year, month):
+    cursor.execute("""
+        INSERT INTO website_month_totals (website_id, year, month, unique_visitors, number_of_visits, pages, hits, bandwidth)
+        SELECT website_id, year, month, COALESCE(SUM(unique_visitors), 0), COALESCE(SUM(number_of_visits), 0),
+        COALESCE(SUM(pages), 0), COALESCE(SUM(hits), 0), COALESCE(SUM(bandwidth), 0)
+        FROM summary WHERE website_id = %s AND year = %s AND month = %s
+        GROUP BY website_id, year, month
+        ON DUPLICATE KEY UPDATE unique_visitors = VALUES(unique_visitors), number_of_visits = VALUES(number_of_visits),
+        pages = VALUES(pages), hits = VALUES(hits), bandwidth = VALUES(bandwidth)
+    """, (website_id, year, month))
+
+# The most visited URLs of a website in a month across all servers
+def top_urls(cursor, website_id, year, month, limit=50):
+    cursor.execute("""
+        SELECT wu.url, t.hits, t.entry_count, t.exit_count FROM website_url_month_totals t
+        INNER JOIN website_url wu ON wu.id = t.website_url_id
+        WHERE t.website_id = %s AND t.year = %s AND t.month = %s
+        ORDER BY t.hits DESC LIMIT %s
+    """, (website_id, year, month, limit))
+    return cursor.fetchall()
+
+# Recompute all rollups from the per-server tables, one website per transaction. Run it once to
+# fill the tables, or after changing website_url_stats or summary outside the scripts, while no
+# ingestion is running.
+def rebuild(connection, cursor):
+    create_rollup_tables(cursor)
+    cursor.execute("SELECT id, name FROM websites ORDER BY id")
+    for website_id, website_name in cursor.fetchall():
+        cursor.execute("DELETE FROM website_url_month_totals WHERE website_id = %s", (website_id,))
+        cursor.execute("DELETE FROM website_month_totals WHERE website_id = %s", (website_id,))
+        cursor.execute("""
+            INSERT INTO website_url_month_totals (website_url_id, website_id, year, month, hits, entry_count, exit_count)
+            SELECT ws.website_url_id, wu.website_id, ws.year, ws.month, SUM(ws.hits), SUM(ws.entry_count), SUM(ws.exit_count)
+            FROM website_url_stats ws
+            INNER JOIN website_url wu ON wu.id = ws.website_url_id
+            WHERE wu.website_id = %s
+            GROUP BY ws.website_url_id, wu.website_id, ws.year, ws.month
+        """, (website_id,))
+        cursor.execute("""
+            INSERT INTO website_month_totals (website_id, year, month, url_hits)
+            SELECT website_id, year, month, SUM(hits) FROM website_url_month_totals
+            WHERE website_id = %s
+            GROUP BY website_id, year, month
+        """, (website_id,))
+        cursor.execute("SELECT DISTINCT year, month FROM summary WHERE website_id = %s", (website_id,))
+        for year, month in cursor.fetchall():
+            refresh_website_month(cursor, website_id, year, month)
+        connection.commit()
+        print(f"Rebuilt rollups for {website_name}.")
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the cross-server rollup tables.')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute every rollup from the per-server tables')
+    args = parser.parse_args()
+
+    connection = get_database_connection()
+    cursor = get_cursor(connection)
+    if args.rebuild:
+        rebuild(connection, cursor)
+    else:
+        create_rollup_tables(cursor)
+        connection.commit()
+        print("Rollup tables are in place; use --rebuild to fill them.")
+    cursor.close()
+    connection.close()
+
+if __name__ == "__main__":
+    main()
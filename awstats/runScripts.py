@@ -1,7 +1,25 @@
 import argparse
-import subprocess
 import os
 import sys
+import time
+
+import metrics
+import summary
+import urls
+from db import ensure_connection, get_cursor, get_database_connection, rollback
+from file_tracking import (DIRECTORIES, collect_files, file_last_modified, file_website, filter_unprocessed,
+                           get_server_id, group_files_by_website)
+from ingest import process_group, run_groups
+from partitions import ensure_file_partitions
+from rollups import create_rollup_tables
+from watcher import DebouncedQueue, get_watcher
+
+# Scripts that can be run, in order. Each module provides SCRIPT_NAME, SECTIONS,
+# parse_sections and ingest_file.
+AVAILABLE_SCRIPTS = {
+    'summary': summary,
+    'urls': urls,
+}  # Add others as necessary
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Run AWStats processing scripts.')
@@ -9,22 +27,106 @@ def parse_arguments():
     parser.add_argument('--file', type=str, help='Specify the file to process')
     parser.add_argument('--force', action='store_true', help='Force processing of the specified file')
     parser.add_argument('--website', type=str, help='Specify the website name')
+    parser.add_argument('--month', type=urls.year_month, help='Only process (and with --force, purge) this month (YYYY-MM)')
+    parser.add_argument('--batch-size', type=int, default=summary.DEFAULT_BATCH_SIZE, help='Number of rows per multi-row INSERT')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes, each with its own DB connection')
+    parser.add_argument('--fetch-workers', type=int, default=urls.FETCH_WORKERS, help='Number of wikis to fetch valid pages from concurrently')
+    parser.add_argument('--incremental', action='store_true', help='Write only the URL stats that changed since the file was last ingested (always on with --watch)')
+    parser.add_argument('--watch', action='store_true', help='Keep running and ingest files as they change')
+    parser.add_argument('--debounce', type=float, default=10, help='Seconds a file must be unchanged before it is ingested in watch mode')
+    parser.add_argument('--poll-interval', type=float, default=30, help='Seconds between directory scans when inotify is unavailable')
+    parser.add_argument('--page-refresh', type=float, default=3600, help='Seconds between valid page refreshes in watch mode')
+    parser.add_argument('--purge-batch-size', type=int, default=urls.DEFAULT_PURGE_BATCH_SIZE, help='Number of URLs purged per transaction with --force')
+    parser.add_argument('--metrics-file', type=str, help='Append per-file and per-run metrics to this JSON lines file')
+    parser.add_argument('--prometheus-file', type=str, help='Write run metrics to this Prometheus textfile-collector file')
     parser.add_argument('--script', nargs='+', help='Specify script(s) to run (e.g., summary)')
     return parser.parse_args()
 
-def run_script(script_name, args):
-    # Build the command with the full path to the script
-    script_path = os.path.join(SCRIPT_DIR, f'{script_name}.py')
-    command = ['python3', script_path]
-    if args.server:
-        command.extend(['--server', args.server])
-    if args.file:
-        command.extend(['--file', args.file])
-    if args.force:
-        command.append('--force')
-    if args.website:
-        command.extend(['--website', args.website])
-    subprocess.run(command)
+# Connection of the main process
+connection = None
+
+def find_pending(files, script_names, force):
+    # Check the listed files against each script's tracked files in bulk; returns
+    # (file_path, server_id, last_modified, script_names) entries and unchanged counts per script
+    cursor = metrics.CountingCursor(get_cursor(connection))
+    pending_names = {}
+    unchanged = {}
+    for name in script_names:
+        pending = filter_unprocessed(cursor, files, AVAILABLE_SCRIPTS[name].SCRIPT_NAME, force)
+        unchanged[name] = len(files) - len(pending)
+        for entry in pending:
+            pending_names.setdefault(entry, []).append(name)
+    # Give new months their partitions before any file transaction is open
+    ensure_file_partitions(cursor, pending_names)
+    cursor.close()
+    return [entry + (names,) for entry, names in pending_names.items()], unchanged
+
+def process_files(files, script_names, force, batch_size, jobs, fetch_workers, options):
+    with metrics.timed('tracking_check'):
+        pending_files, unchanged = find_pending(files, script_names, force)
+    for name in script_names:
+        print(f"{unchanged[name]} files have already been processed by {name}.")
+
+    if 'urls' in script_names:
+        with metrics.timed('api_fetch'):
+            urls.prefetch_websites([entry for entry in pending_files if 'urls' in entry[3]], fetch_workers)
+    groups = group_files_by_website(pending_files)
+    totals = {name: {'processed': 0, 'skipped': 0, 'failed': 0} for name in script_names}
+    run_groups(connection, groups, process_group, (script_names, force, batch_size, options), jobs, totals)
+    for name in script_names:
+        totals[name]['skipped'] += unchanged[name]
+    return totals
+
+def print_totals(totals):
+    for name, counts in totals.items():
+        print(f"{name}: processed {counts['processed']}, skipped {counts['skipped']}, failed {counts['failed']} files.")
+
+def watch(directories, script_names, args, options):
+    # Keep the connection, website ids and valid-page cache warm and ingest files shortly after they change
+    watcher = get_watcher(directories, args.poll_interval)
+    queue = DebouncedQueue(args.debounce)
+    pages_loaded = time.monotonic()
+    print(f"Watching {len(directories)} directories for changed AWStats files...")
+    try:
+        while True:
+            timeout = queue.next_timeout()
+            queue.add(watcher.poll(args.poll_interval if timeout is None else min(timeout, args.poll_interval)))
+            ready = queue.pop_ready()
+            if not ready:
+                continue
+
+            # Let the page cache pick up new and deleted pages now and then
+            if time.monotonic() - pages_loaded >= args.page_refresh:
+                urls.reset_valid_pages()
+                pages_loaded = time.monotonic()
+
+            files = []
+            for file_path in ready:
+                if not os.path.exists(file_path):
+                    continue
+                if args.website and file_website(file_path) != args.website:
+                    continue
+                server_id = get_server_id(os.path.dirname(file_path))
+                files.append((file_path, server_id, file_last_modified(os.stat(file_path))))
+            if not files:
+                continue
+
+            # A failed batch (lost connection, lock timeout, file renamed away) must not stop the
+            # watch; its files are picked up again when they next change
+            try:
+                ensure_connection(connection)
+                # Each batch is reported as a run of its own
+                metrics.reset()
+                totals = process_files(files, script_names, False, args.batch_size, 1, args.fetch_workers, options)
+                print_totals(totals)
+                metrics.write(args.metrics_file, args.prometheus_file, script_names, totals)
+            except Exception as e:
+                rollback(connection)
+                print(f"Error processing watch batch of {len(files)} files: {e}")
+    except KeyboardInterrupt:
+        print("Stopping watch.")
+    finally:
+        watcher.close()
 
 def main():
     global SCRIPT_DIR  # Set this as a global variable for use in other functions
@@ -35,20 +137,58 @@ def main():
 
     args = parse_arguments()
 
-    # List of available scripts
-    available_scripts = ['summary', 'urls']  # Add others as necessary
-
     if args.script:
         # Run only the specified scripts
+        script_names = []
         for script in args.script:
-            if script in available_scripts:
-                run_script(script, args)
+            if script in AVAILABLE_SCRIPTS:
+                script_names.append(script)
             else:
                 print(f"Script '{script}' not found in available scripts.")
     else:
         # Run all scripts
-        for script in available_scripts:
-            run_script(script, args)
+        script_names = list(AVAILABLE_SCRIPTS)
+    if not script_names:
+        return
+
+    directories = DIRECTORIES
+    if args.server:
+        directories = [dir for dir in directories if args.server in dir]
+        if not directories:
+            print(f"No directory found for server '{args.server}'.")
+            return
+
+    global connection
+    connection = get_database_connection()
+    # purge_forced_stats commits through the urls module's connection
+    urls.connection = connection
+
+    cursor = get_cursor(connection)
+    create_rollup_tables(cursor)
+    if args.force and 'urls' in script_names:
+        if not urls.purge_forced_stats(cursor, args, args.purge_batch_size):
+            return
+    cursor.close()
+    # Commit the purge before processing so pool workers do not wait on its locks
+    connection.commit()
+
+    # Keyword arguments passed to a single script's ingest_file. A watched file is ingested again
+    # every time AWStats rewrites it, and the current month's files were usually ingested by an
+    # earlier run, so with --watch urls stores the difference to the previous ingest from the
+    # first pass on rather than adding the month's counts once more
+    options = {'urls': {'incremental': args.incremental or args.watch}}
+
+    # List every directory once and process what changed
+    with metrics.timed('scan'):
+        files = collect_files(directories, args.file, args.website, args.month)
+    totals = process_files(files, script_names, args.force, args.batch_size, args.jobs, args.fetch_workers, options)
+    print_totals(totals)
+    metrics.write(args.metrics_file, args.prometheus_file, script_names, totals)
+
+    if args.watch:
+        watch(directories, script_names, args, options)
+
+    connection.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,109 @@
+import re
+import sqlite3
+from datetime import datetime
+
+# Embedded SQLite storage backend, used when DB_BACKEND=sqlite and by the benchmark. It stands
+# in for a mysql.connector connection: the scripts' MySQL queries are rewritten to SQLite's
+# dialect, so the same upsert, tracking and rollup code writes to a local database file and
+# ingestion can be run and checked without a MySQL server. Partitioning and LOAD DATA (--bulk)
+# are MySQL only.
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS websites (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+    CREATE TABLE IF NOT EXISTS website_url (id INTEGER PRIMARY KEY, website_id INTEGER, url TEXT,
+        UNIQUE (website_id, url));
+    CREATE TABLE IF NOT EXISTS website_url_stats (website_url_id INTEGER, server_id INTEGER, year INTEGER,
+        month INTEGER, hits INTEGER, entry_count INTEGER, exit_count INTEGER,
+        PRIMARY KEY (website_url_id, server_id, year, month));
+    CREATE TABLE IF NOT EXISTS summary (website_id INTEGER, server_id INTEGER, year INTEGER, month INTEGER,
+        day INTEGER, unique_visitors INTEGER, number_of_visits INTEGER, pages INTEGER,
+        hits INTEGER, bandwidth INTEGER, PRIMARY KEY (website_id, server_id, year, month, day));
+    CREATE TABLE IF NOT EXISTS website_month_totals (website_id INTEGER, year INTEGER, month INTEGER,
+        unique_visitors INTEGER DEFAULT 0, number_of_visits INTEGER DEFAULT 0, pages INTEGER DEFAULT 0,
+        hits INTEGER DEFAULT 0, bandwidth INTEGER DEFAULT 0, url_hits INTEGER DEFAULT 0,
+        PRIMARY KEY (website_id, year, month));
+    CREATE TABLE IF NOT EXISTS website_url_month_totals (website_url_id INTEGER, website_id INTEGER, year INTEGER,
+        month INTEGER, hits INTEGER DEFAULT 0, entry_count INTEGER DEFAULT 0, exit_count INTEGER DEFAULT 0,
+        PRIMARY KEY (website_url_id, year, month));
+    CREATE INDEX IF NOT EXISTS top_urls ON website_url_month_totals (website_id, year, month, hits);
+    CREATE TABLE IF NOT EXISTS file_tracking (filename TEXT, server_id INTEGER, last_modified DATETIME,
+        processed_date DATETIME, script_name TEXT, PRIMARY KEY (filename, server_id, script_name));
+"""
+
+# DATETIME columns are stored as 'YYYY-MM-DD HH:MM:SS' and read back as datetime, so tracked
+# modification times compare equal to the ones of the directory listing
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.queries = 0
+
+    @staticmethod
+    def translate(query):
+        query = query.replace('%s', '?').replace('INSERT IGNORE', 'INSERT OR IGNORE')
+        query = query.replace('ON DUPLICATE KEY UPDATE', 'ON CONFLICT DO UPDATE SET')
+        # Secondary indexes are created separately in SCHEMA
+        query = re.sub(r',\s*INDEX \w+ \([^)]*\)', '', query)
+        return re.sub(r'VALUES\((\w+)\)', r'excluded.\1', query)
+
+    def execute(self, query, params=()):
+        self.queries += 1
+        self.cursor.execute(self.translate(query), params)
+
+    def executemany(self, query, rows):
+        self.queries += 1
+        self.cursor.executemany(self.translate(query), rows)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def close(self):
+        self.cursor.close()
+
+class SQLiteConnection:
+    def __init__(self, path=':memory:'):
+        # Pool workers writing to the same file wait for each other's transactions
+        self.connection = sqlite3.connect(path, timeout=60, detect_types=sqlite3.PARSE_DECLTYPES)
+        if path != ':memory:':
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.cursors = []
+
+    def cursor(self, **kwargs):
+        cursor = SQLiteCursor(self.connection.cursor())
+        self.cursors.append(cursor)
+        return cursor
+
+    # Queries run through all cursors of the connection
+    @property
+    def queries(self):
+        return sum(cursor.queries for cursor in self.cursors)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self.connection.close()
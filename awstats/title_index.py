@@ -0,0 +1,88 @@
+import zlib
+from array import array
+from bisect import bisect_left
+
+# Compact membership index of a wiki's valid page titles, used instead of a set of title strings
+# so several large wikis can be held in memory at once. Titles are sorted by a 64-bit hash and
+# kept as one UTF-8 blob with an offsets array next to the array of hashes, which takes a few
+# bytes per title on top of the title itself instead of a str object and a set slot. A directory
+# of where each range of leading hash bits starts narrows every binary search to a few entries.
+#
+# A lookup finds the title's hash and then compares the stored title bytes, so it is always
+# exact: two titles with the same hash are both kept in the run of equal hashes, and a URL that
+# only shares its hash with a title is not taken for it.
+
+# Average number of titles per directory bucket
+BUCKET_SIZE = 8
+
+# Records checked per batch by filter_records
+DEFAULT_CHUNK_SIZE = 1000
+
+# Stable 64-bit hash of a title's UTF-8 bytes; unlike hash() it is the same in every process.
+# It only has to spread titles evenly, as equal hashes are told apart by the title itself.
+def title_hash(key):
+    return zlib.crc32(key) << 32 | zlib.adler32(key)
+
+class TitleIndex:
+    def __init__(self, titles=()):
+        entries = sorted({(title_hash(key), key) for key in (title.encode('utf-8') for title in titles)})
+        self.hashes = array('Q', (hash_value for hash_value, _ in entries))
+        offsets = [0]
+        for _, key in entries:
+            offsets.append(offsets[-1] + len(key))
+        self.offsets = array('I' if offsets[-1] < 2 ** 32 else 'Q', offsets)
+        self.blob = b''.join(key for _, key in entries)
+
+        # buckets[b] is the position of the first hash whose leading bits are b or more
+        bits = max(len(entries) // BUCKET_SIZE, 1).bit_length()
+        self.shift = 64 - bits
+        counts = [0] * (2 ** bits + 1)
+        for hash_value in self.hashes:
+            counts[(hash_value >> self.shift) + 1] += 1
+        for bucket in range(1, len(counts)):
+            counts[bucket] += counts[bucket - 1]
+        self.buckets = array('I' if len(entries) < 2 ** 32 else 'Q', counts)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __iter__(self):
+        for position in range(len(self.hashes)):
+            yield self.key_at(position).decode('utf-8')
+
+    def __contains__(self, title):
+        return self.contains_key(title.encode('utf-8'))
+
+    def key_at(self, position):
+        return self.blob[self.offsets[position]:self.offsets[position + 1]]
+
+    # Titles sharing a hash sit next to each other, so each of them is compared in turn
+    def contains_key(self, key):
+        hash_value = title_hash(key)
+        bucket = hash_value >> self.shift
+        position = bisect_left(self.hashes, hash_value, self.buckets[bucket], self.buckets[bucket + 1])
+        while position < len(self.hashes) and self.hashes[position] == hash_value:
+            if self.key_at(position) == key:
+                return True
+            position += 1
+        return False
+
+    # Check a batch of titles at once; returns a list of booleans in the order given
+    def contains_batch(self, titles):
+        contains_key = self.contains_key
+        return [contains_key(title.encode('utf-8')) for title in titles]
+
+    # Yield the (url, fields) records whose URL is a valid title, checking them chunk by chunk
+    def filter_records(self, records, chunk_size=DEFAULT_CHUNK_SIZE):
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield from self.select(chunk)
+                chunk = []
+        yield from self.select(chunk)
+
+    def select(self, records):
+        for record, valid in zip(records, self.contains_batch([record[0] for record in records])):
+            if valid:
+                yield record
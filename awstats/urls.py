@@ -3,218 +3,168 @@ SCRIPT_NAME = 'urls'
 
 import os
 import argparse
-import mysql.connector
-import requests
-from datetime import datetime
-from urllib.parse import unquote
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Database credentials from .env
-db_host = os.getenv('DB_HOST')
-db_user = os.getenv('DB_USER')
-db_password = os.getenv('DB_PASSWORD')
-db_name = os.getenv('DB_NAME')
-
-# Database connection
-def get_database_connection():
-    return mysql.connector.connect(
-        host=db_host,
-        user=db_user,
-        password=db_password,
-        database=db_name
-    )
+from awstats_reader import open_data_file, parse_begin_map, iter_pos_sider
+from file_tracking import (DIRECTORIES, collect_files, file_website, filter_unprocessed, get_server_id,
+                           group_files_by_website, update_file_tracking)
+import metrics
+from db import DB_BACKEND, ensure_connection, execute_batched, get_cursor, get_database_connection, rollback
+from ingest import run_groups
+from bulk_load import StagingFile
+from purge import DEFAULT_PURGE_BATCH_SIZE, purge_url_stats
+from rollups import add_url_deltas, create_rollup_tables
+from page_cache import FETCH_WORKERS, get_valid_pages, prefetch_valid_pages
+from partitions import ensure_file_partitions
+
+# Number of rows sent to the server per multi-row INSERT
+DEFAULT_BATCH_SIZE = 1000
+
+# Rows written per transaction before it is committed; 0 commits after every file
+DEFAULT_COMMIT_ROWS = 0
 
 # Determine the path to the script directory
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Map directories to server IDs
-def get_server_id(directory):
-    server_mapping = {
-        '/var/lib/awstats': 1,
-        '/home/private/server_stats/frankfurt': 2,
-        '/home/private/server_stats/saopaulo': 4,
-        '/home/private/server_stats/singapore': 3
-    }
-    return server_mapping.get(directory)
+# Website ids stay valid for the life of the process
+website_ids_cache = {}
 
 # Get or create a website entry
 def get_website_id(cursor, website_name):
+    if website_name in website_ids_cache:
+        return website_ids_cache[website_name]
     cursor.execute("SELECT id FROM websites WHERE name = %s", (website_name,))
     result = cursor.fetchone()
     if result:
+        website_ids_cache[website_name] = result[0]
         return result[0]
     else:
         raise ValueError(f"Website '{website_name}' not found in database.")
 
-# Check if the file has been processed
-def has_file_been_processed(cursor, filename, server_id, last_modified, force, script_name):
-    if force:
-        return False  # Bypass the processing check if force is True
-    # Check if file has been processed
-    cursor.execute("""
-        SELECT last_modified FROM file_tracking
-        WHERE filename = %s AND server_id = %s AND script_name = %s
-    """, (filename, server_id, script_name))
-    result = cursor.fetchone()
-    return result and result[0] == last_modified
-
-# Update file tracking table
-def update_file_tracking(cursor, filename, server_id, last_modified, script_name):
-    # Update the file_tracking table
-    cursor.execute("""
-        INSERT INTO file_tracking (filename, server_id, last_modified, processed_date, script_name)
-        VALUES (%s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE last_modified = VALUES(last_modified), processed_date = VALUES(processed_date)
-    """, (filename, server_id, last_modified, datetime.now().replace(microsecond=0), script_name))
-
-# Fetch valid content pages from MediaWiki API
-def get_valid_content_pages(api_url):
-    valid_pages = set()
-    params = {
-        'action': 'query',
-        'list': 'allpages',
-        'aplimit': 'max',
-        'format': 'json',
-        'redirects': '1',
-        'apfilterredir': 'nonredirects',
-    }
-    while True:
-        response = requests.get(api_url, params=params)
-        data = response.json()
-
-        # Handle potential API errors
-        if 'error' in data:
-            raise Exception(f"MediaWiki API error: {data['error']['info']}")
-
-        for page in data['query']['allpages']:
-            title = page['title']
-            title = title.replace('_', ' ')
-            title = unquote(title)
-            valid_pages.add(title)
-
-        if 'continue' in data:
-            params.update(data['continue'])
-        else:
-            break
-    return valid_pages
-
-# Parse the BEGIN_MAP section to get positions
-def parse_begin_map(file):
-    positions = {}
-    for line in file:
-        line = line.decode('utf-8').strip()
-        if line.startswith('BEGIN_MAP'):
-            continue
-        elif line.startswith('END_MAP'):
-            break
-        else:
-            parts = line.split()
-            if len(parts) == 2 and parts[0].startswith('POS_'):
-                positions[parts[0]] = int(parts[1])
-    return positions
-
-# Parse POS_SIDER section
-def parse_pos_sider(file, pos_sider_offset):
-    file.seek(pos_sider_offset)
-    url_data = []
-    for line in file:
-        line = line.decode('utf-8').strip()
-        if line.startswith('END_SIDER'):
-            break
-        elif not line.startswith('#') and not line.startswith('BEGIN_SIDER'):
-            parts = line.split()
-            if len(parts) == 5:  # URL, Pages, Bandwidth, Entry, Exit
-                raw_url = parts[0]
-
-                # Now proceed with URL processing
-                url = raw_url
-
-                # Remove leading slash if present
-                if url.startswith('/'):
-                    url = url[1:]
-
-                # Remove 'wiki/' prefix if present
-                if url.startswith('wiki/'):
-                    url = url[len('wiki/'):]
-
-                # Decode URL-encoded characters
-                url = unquote(url)
-
-                # Replace underscores with spaces
-                url = url.replace('_', ' ')
-
-                pages, bandwidth, entry, exit_ = map(int, parts[1:])
-                url_data.append({
-                    'url': url,
-                    'pages': pages,
-                    'bandwidth': bandwidth,
-                    'entry': entry,
-                    'exit': exit_
-                })
-    return url_data
-
-# Get or create a website_url entry
-def get_or_create_website_url_id(cursor, website_id, url):
+# Load every (url, id) pair of a website into an in-memory index
+def load_website_url_ids(cursor, website_id):
+    cursor.execute("SELECT url, id FROM website_url WHERE website_id = %s", (website_id,))
+    return dict(cursor.fetchall())
+
+# Bulk insert the URLs missing from the index and read their ids back into it
+def insert_website_urls(cursor, url_ids, website_id, urls, batch_size=DEFAULT_BATCH_SIZE):
+    missing = [url for url in urls if url not in url_ids]
+    if not missing:
+        return 0
+    execute_batched(cursor, "INSERT IGNORE INTO website_url (website_id, url) VALUES (%s, %s)",
+                    [(website_id, url) for url in missing], batch_size)
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        cursor.execute(f"SELECT url, id FROM website_url WHERE website_id = %s AND url IN ({placeholders})",
+                       (website_id, *chunk))
+        url_ids.update(cursor.fetchall())
+    return len(missing)
+
+# Get or create a website_url entry, serving lookups from the in-memory index
+def get_or_create_website_url_id(cursor, url_ids, website_id, url):
+    if url in url_ids:
+        return url_ids[url]
     cursor.execute("SELECT id FROM website_url WHERE website_id = %s AND url = %s", (website_id, url))
     result = cursor.fetchone()
     if result:
+        url_ids[url] = result[0]
         return result[0]
     cursor.execute("INSERT INTO website_url (website_id, url) VALUES (%s, %s)", (website_id, url))
+    url_ids[url] = cursor.lastrowid
     return cursor.lastrowid
 
-# Update server stats
-def update_server_stats(cursor, website_url_id, server_id, year, month, data):
-    cursor.execute("""
+# Update server stats for a batch of (website_url_id, server_id, year, month, hits, entry, exit) rows
+# and add the same rows to the cross-server rollups
+def update_server_stats(cursor, website_id, rows, batch_size=DEFAULT_BATCH_SIZE):
+    execute_batched(cursor, """
         INSERT INTO website_url_stats (website_url_id, server_id, year, month, hits, entry_count, exit_count)
         VALUES (%s, %s, %s, %s, %s, %s, %s)
         ON DUPLICATE KEY UPDATE
         hits = hits + VALUES(hits),
         entry_count = entry_count + VALUES(entry_count),
         exit_count = exit_count + VALUES(exit_count)
-    """, (website_url_id, server_id, year, month, data['pages'], data['entry'], data['exit']))
+    """, rows, batch_size)
+    add_url_deltas(cursor, website_id, rows, batch_size)
+
+# Load the stored counters of a website's URLs for one server and month, keyed by website_url_id
+def load_url_stats(cursor, website_id, server_id, year, month):
+    cursor.execute("""
+        SELECT ws.website_url_id, ws.hits, ws.entry_count, ws.exit_count FROM website_url_stats ws
+        INNER JOIN website_url wu ON ws.website_url_id = wu.id
+        WHERE wu.website_id = %s AND ws.server_id = %s AND ws.year = %s AND ws.month = %s
+    """, (website_id, server_id, year, month))
+    return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+# Each monthly file is the only source of its (website, server, year, month) rows, so the stored
+# rows are the snapshot of the last ingested version of the file. Return stats rows holding only
+# the differences between that snapshot and the file's current counters, and the unchanged count.
+def diff_url_stats(previous, current, server_id, year, month):
+    rows = []
+    for website_url_id in current.keys() | previous.keys():
+        old = previous.get(website_url_id, (0, 0, 0))
+        new = current.get(website_url_id, (0, 0, 0))
+        if old != new:
+            rows.append((website_url_id, server_id, year, month,
+                         new[0] - old[0], new[1] - old[1], new[2] - old[2]))
+    return rows, len(current.keys() | previous.keys()) - len(rows)
 
 # Global caches to prevent multiple fetches and insertions per domain
 valid_pages_cache = {}
 valid_urls_inserted = set()
+website_url_ids_cache = {}
+
+# Drop the valid pages of every website so they are reloaded (and new ones inserted) on next use
+def reset_valid_pages():
+    valid_pages_cache.clear()
+    valid_urls_inserted.clear()
+
+# A rolled back file may have put ids of URLs that were never committed in the index, and
+# its valid URL inserts are gone with it
+def discard_uncommitted_state():
+    website_url_ids_cache.clear()
+    valid_urls_inserted.clear()
 
 # Global variables
 excluded_websites = ['fr.bahai.works', 'bahaiconcordance.org']
 
-# Process a single AWStats file
-def process_file(cursor, file_path, server_id, force):
-    global valid_pages_cache
-    global valid_urls_inserted
+# AWStats sections this script reads
+SECTIONS = ('POS_SIDER',)
 
-    filename = os.path.basename(file_path)
-    last_modified = datetime.fromtimestamp(os.path.getmtime(file_path)).replace(microsecond=0)
+# Parse the sections needed by this script, or return None if they are missing. SIDER records
+# are streamed, so ingest_file must run while the data file is still open.
+def parse_sections(data, positions):
+    if 'POS_SIDER' not in positions:
+        return None
+    return {'sider_records': iter_pos_sider(data, positions['POS_SIDER'])}
 
-    # Check if the file has already been processed
-    if has_file_been_processed(cursor, filename, server_id, last_modified, force, SCRIPT_NAME):
-        print(f"File {filename} has already been processed by {SCRIPT_NAME}.")
-        return
+# Process a single AWStats file
+def process_file(cursor, file_path, server_id, last_modified, force, batch_size=DEFAULT_BATCH_SIZE, incremental=False, staging=None):
+    filename = os.path.basename(file_path)
 
-    with open(file_path, 'rb') as file:
+    with open_data_file(file_path) as data:
         # Parse BEGIN_MAP to get section positions
-        positions = parse_begin_map(file)
+        positions = parse_begin_map(data)
+        parsed = parse_sections(data, positions)
+        return ingest_file(cursor, filename, server_id, last_modified, parsed, force, batch_size, incremental, staging)
 
-        # Verify the required POS_SIDER section is available
-        if 'POS_SIDER' not in positions:
-            print(f"POS_SIDER section not found in {filename}")
-            return
+# Write the sections returned by parse_sections and mark the file as processed
+def ingest_file(cursor, filename, server_id, last_modified, parsed, force, batch_size=DEFAULT_BATCH_SIZE, incremental=False, staging=None):
+    global valid_pages_cache
+    global valid_urls_inserted
+    global website_url_ids_cache
 
-        # Parse the POS_SIDER section
-        sider_data = parse_pos_sider(file, positions['POS_SIDER'])
+    # Verify the required POS_SIDER section is available
+    if parsed is None:
+        print(f"POS_SIDER section not found in {filename}")
+        return 'skipped'
+    sider_records = parsed['sider_records']
 
     # Extract website name from filename
-    website_name = '.'.join(filename.split('.')[1:-1])
+    website_name = file_website(filename)
 
     # Check if the website is in the exclusion list
     if website_name in excluded_websites:
         print(f"Skipping excluded website '{website_name}'.")
-        return
+        return 'skipped'
         
     website_id = get_website_id(cursor, website_name)
 
@@ -223,32 +173,29 @@ def process_file(cursor, file_path, server_id, force):
         valid_pages = valid_pages_cache[website_name]
         print(f"Using cached valid pages for {website_name}.")
     else:
-        # Construct the API URL
-        api_url = f'https://{website_name}/api.php'
-
-        # Fetch valid content pages from MediaWiki API
-        print(f"Fetching valid content pages from MediaWiki API at {api_url}...")
+        # Load valid content pages from the on-disk cache, refreshing it from the MediaWiki API
         try:
-            valid_pages = get_valid_content_pages(api_url)
+            with metrics.timed('api_fetch'):
+                valid_pages = get_valid_pages(website_name)
             # Cache the valid pages
             valid_pages_cache[website_name] = valid_pages
         except Exception as e:
             print(f"Error fetching valid pages for {website_name}: {e}")
-            return
+            return 'failed'
         print(f"Retrieved {len(valid_pages)} valid pages for {website_name}.")
 
-    # Insert valid URLs into website_url table only once per website
+    # Load the url -> id index for the website once per execution
+    if website_id not in website_url_ids_cache:
+        website_url_ids_cache[website_id] = load_website_url_ids(cursor, website_id)
+    url_ids = website_url_ids_cache[website_id]
+
+    # Insert valid URLs into website_url table only once per website. They are committed with
+    # the file's stats; if the file is rolled back, the next file inserts them again.
     if website_name not in valid_urls_inserted:
         print(f"Inserting valid URLs into database for {website_name}...")
-        for url in valid_pages:
-            # Check if the URL already exists
-            cursor.execute("SELECT id FROM website_url WHERE website_id = %s AND url = %s", (website_id, url))
-            result = cursor.fetchone()
-            if not result:
-                cursor.execute("INSERT INTO website_url (website_id, url) VALUES (%s, %s)", (website_id, url))
-        # Commit the insertion of valid URLs
-        connection.commit()
+        inserted = insert_website_urls(cursor, url_ids, website_id, valid_pages, batch_size)
         valid_urls_inserted.add(website_name)
+        print(f"Inserted {inserted} new URLs for {website_name}.")
     else:
         print(f"Valid URLs for {website_name} already inserted during this execution.")
 
@@ -259,31 +206,228 @@ def process_file(cursor, file_path, server_id, force):
     # If force is True, delete existing data related to the website, server, year, and month
     if force:
         print(f"Force option detected. Deleting existing stats for {website_name} for {year}-{month:02d}...")
-        # Delete stats for the specified website, server, year, and month
-        cursor.execute("""
-            DELETE ws FROM website_url_stats ws
-            INNER JOIN website_url wu ON ws.website_url_id = wu.id
-            WHERE wu.website_id = %s AND ws.server_id = %s AND ws.year = %s AND ws.month = %s
-        """, (website_id, server_id, year, month))
-        # Delete unused URLs for the website if they have no stats
-        cursor.execute("""
-            DELETE wu FROM website_url wu
-            LEFT JOIN website_url_stats ws ON wu.id = ws.website_url_id
-            WHERE wu.website_id = %s AND ws.website_url_id IS NULL
-        """, (website_id,))
-
-    # Insert or update stats for each URL in POS_SIDER
-    for data in sider_data:
-        url = data['url']
-        if url not in valid_pages:
-            continue  # Skip URLs not in the list of valid pages
-
-        website_url_id = get_or_create_website_url_id(cursor, website_id, url)
-        update_server_stats(cursor, website_url_id, server_id, year, month, data)
+        # Delete stats for the specified website, server, year, and month, and URLs left without
+        # stats, inside this file's transaction so a failed file keeps its old stats. Without
+        # commits the purge only needs the cursor, so it works in any worker process.
+        purge_url_stats(None, cursor, website_id=website_id, server_id=server_id, year=year, month=month,
+                        commit=False)
+        # The purge removed valid URLs without stats, so rebuild the index and put them back
+        url_ids = website_url_ids_cache[website_id] = load_website_url_ids(cursor, website_id)
+        insert_website_urls(cursor, url_ids, website_id, valid_pages, batch_size)
+
+    if staging is not None:
+        # Stage the valid records for a set-based merge, which also resolves the URL ids
+        for url, fields in valid_pages.filter_records(sider_records, batch_size):
+            staging.write(website_id, server_id, year, month, url, int(fields[0]), int(fields[2]), int(fields[3]))
+        staging.track(filename, server_id, last_modified)
+        print(f"Staged file {filename}.")
+        return 'processed'
+
+    # Stream the SIDER records: filter them against the valid pages a batch at a time, then
+    # parse only the kept counters
+    valid_records = (
+        (get_or_create_website_url_id(cursor, url_ids, website_id, url), int(fields[0]), int(fields[2]), int(fields[3]))
+        for url, fields in valid_pages.filter_records(sider_records, batch_size)
+    )
+
+    if incremental:
+        # Sum the file's counters per URL and write only what changed since the last run
+        current = {}
+        for website_url_id, pages, entry, exit_ in valid_records:
+            hits, entry_count, exit_count = current.get(website_url_id, (0, 0, 0))
+            current[website_url_id] = (hits + pages, entry_count + entry, exit_count + exit_)
+        previous = load_url_stats(cursor, website_id, server_id, year, month)
+        stats_rows, unchanged = diff_url_stats(previous, current, server_id, year, month)
+        update_server_stats(cursor, website_id, stats_rows, batch_size)
+        metrics.target()['rows_unchanged'] += unchanged
+        print(f"Wrote {len(stats_rows)} changed URL stats for {filename}, {unchanged} unchanged.")
+    else:
+        # Insert or update stats for each valid URL, flushing every batch_size rows
+        stats_rows = []
+        for website_url_id, pages, entry, exit_ in valid_records:
+            stats_rows.append((website_url_id, server_id, year, month, pages, entry, exit_))
+            if len(stats_rows) >= batch_size:
+                update_server_stats(cursor, website_id, stats_rows, batch_size)
+                stats_rows = []
+        update_server_stats(cursor, website_id, stats_rows, batch_size)
 
     # Update the file tracking to mark it as processed
     update_file_tracking(cursor, filename, server_id, last_modified, SCRIPT_NAME)
     print(f"Processed file {filename}.")
+    return 'processed'
+
+# argparse type for --month: 'YYYY-MM' as a (year, month) tuple
+def year_month(value):
+    try:
+        year, month = (int(part) for part in value.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid month '{value}', expected YYYY-MM")
+    if not 1 <= month <= 12:
+        raise argparse.ArgumentTypeError(f"invalid month '{value}', expected YYYY-MM")
+    return year, month
+
+# Fetch the valid pages of every website found in the file list concurrently
+def prefetch_websites(files, max_workers=FETCH_WORKERS):
+    website_names = {file_website(entry[0]) for entry in files}
+    website_names -= set(excluded_websites) | set(valid_pages_cache)
+    if website_names:
+        print(f"Prefetching valid pages for {len(website_names)} websites...")
+        valid_pages_cache.update(prefetch_valid_pages(website_names, max_workers))
+
+# Process a group of files and count the outcomes. A file's stats are committed in the same
+# transaction as its file_tracking row, so an interrupted run resumes with the first file that
+# was not committed. By default every file is committed on its own; with commit_rows, files
+# share a transaction until it holds that many written rows, and a failed file is rolled back
+# to the savepoint taken before it. Files are never split across transactions.
+def process_group(connection, files, force, batch_size, incremental=False, bulk=False, commit_rows=DEFAULT_COMMIT_ROWS):
+    results = {'processed': 0, 'skipped': 0, 'failed': 0}
+    cursor = metrics.CountingCursor(get_cursor(connection))
+    staging = StagingFile() if bulk else None
+    # File records of the open transaction, the rows written in it and where the staging file
+    # stood when it began
+    pending = []
+    pending_rows = 0
+    transaction_checkpoint = staging.checkpoint() if staging else None
+
+    def end_transaction():
+        nonlocal pending_rows, transaction_checkpoint
+        pending.clear()
+        pending_rows = 0
+        transaction_checkpoint = staging.checkpoint() if staging else None
+
+    # The open transaction was rolled back as a whole, so its files were not stored after all
+    def lose_pending(reason):
+        print(f"{reason}; {len(pending)} uncommitted files are left for the next run.")
+        for record in pending:
+            record['status'] = 'failed'
+        results['processed'] -= len(pending)
+        results['failed'] += len(pending)
+        discard_uncommitted_state()
+        if staging:
+            staging.rewind(transaction_checkpoint)
+        end_transaction()
+
+    def commit_transaction():
+        try:
+            with metrics.timed('commit'):
+                connection.commit()
+        except Exception as e:
+            rollback(connection)
+            lose_pending(f"Error committing {len(pending)} files: {e}")
+            return
+        end_transaction()
+
+    # Undo a failed file, keeping the files before it in the open transaction when possible
+    def rollback_file(checkpoint):
+        discard_uncommitted_state()
+        if staging:
+            staging.rewind(checkpoint)
+        if commit_rows and pending:
+            try:
+                cursor.execute("ROLLBACK TO SAVEPOINT file_start")
+                return
+            except Exception as e:
+                print(f"Rollback to savepoint failed: {e}")
+        rollback(connection)
+        if pending:
+            lose_pending("Rolled back the open transaction")
+
+    for file_path, server_id, last_modified in files:
+        # A reconnected session has lost its prepared statements and its open transaction
+        if ensure_connection(connection):
+            cursor = metrics.CountingCursor(get_cursor(connection))
+            if pending:
+                lose_pending("Database connection lost")
+        checkpoint = staging.checkpoint() if staging else None
+        with metrics.file_record(SCRIPT_NAME, file_path, server_id) as record:
+            try:
+                if commit_rows:
+                    cursor.execute("SAVEPOINT file_start")
+                status = process_file(cursor, file_path, server_id, last_modified, force, batch_size, incremental, staging)
+            except Exception as e:
+                print(f"Error processing file {file_path}: {e}")
+                rollback_file(checkpoint)
+                status = 'failed'
+            record['status'] = status
+            results[status] += 1
+            if status == 'processed':
+                pending.append(record)
+                pending_rows += record['rows_written']
+            if pending and pending_rows >= commit_rows:
+                commit_transaction()
+    if pending:
+        commit_transaction()
+
+    # Bulk mode: merge the group's staged records and mark its files processed in one transaction
+    if staging:
+        try:
+            staging.merge(cursor, SCRIPT_NAME, update_file_tracking)
+            with metrics.timed('commit'):
+                connection.commit()
+        except Exception as e:
+            rollback(connection)
+            discard_uncommitted_state()
+            print(f"Error bulk loading {len(staging.tracking)} staged files: {e}")
+            results['failed'] += len(staging.tracking)
+            results['processed'] -= len(staging.tracking)
+        finally:
+            staging.close()
+    cursor.close()
+    return results
+
+# Delete existing stats selected by --website/--server/--file, or everything when none is given,
+# in chunks of purge_batch_size URLs. --month limits the website and server purges to one month,
+# or on its own purges that month, truncating its partition when website_url_stats is
+# partitioned. Returns False if the selection is invalid.
+def purge_forced_stats(cursor, args, purge_batch_size=DEFAULT_PURGE_BATCH_SIZE):
+    year, month = args.month or (None, None)
+    period = f" for {year}-{month:02d}" if args.month else ''
+    if args.website:
+        # Get the website_id
+        website_id = get_website_id(cursor, args.website)
+        # Delete stats and unused URLs for the specified website
+        print(f"Purging stats for website '{args.website}'{period}...")
+        purge_url_stats(connection, cursor, website_id=website_id, year=year, month=month, batch_size=purge_batch_size)
+    if args.server:
+        # Retrieve 'server_id' based on 'args.server'
+        server_id = get_server_id(f'/home/private/server_stats/{args.server}')
+        if server_id is None:
+            print(f"Invalid server name '{args.server}'")
+            return False
+        # Delete stats for the specified server and unused website_url entries
+        print(f"Purging stats for server '{args.server}'{period}...")
+        purge_url_stats(connection, cursor, server_id=server_id, year=year, month=month, batch_size=purge_batch_size)
+    if args.file:
+        # Extract website_name, year, and month from args.file
+        filename = args.file
+        filename_without_extension = filename[:-4]  # Remove '.txt'
+        parts = filename_without_extension.split('.')
+        if len(parts) < 2:
+            print(f"Invalid file name format '{args.file}'. Cannot extract website name.")
+            return False
+        # Extract website name
+        website_name = '.'.join(parts[1:])
+        # Extract year and month from file name (assuming format 'awstatsMMYYYY')
+        import re
+        match = re.match(r'awstats(\d{2})(\d{4})', filename_without_extension)
+        if match:
+            month_str, year_str = match.groups()
+            month = int(month_str)
+            year = int(year_str)
+        else:
+            print(f"Invalid file name format '{args.file}'. Cannot extract year and month.")
+            return False
+        # Get website_id
+        website_id = get_website_id(cursor, website_name)
+        # Delete stats for the specified website, year, and month, and URLs left without stats
+        print(f"Purging stats for {website_name} for {year}-{month:02d}...")
+        purge_url_stats(connection, cursor, website_id=website_id, year=year, month=month,
+                        batch_size=purge_batch_size)
+    if not args.website and not args.server and not args.file:
+        # Delete all stats and URLs, or those of the month
+        print(f"Purging all URL stats{period}...")
+        purge_url_stats(connection, cursor, year=year, month=month, batch_size=purge_batch_size)
+    return True
 
 # Main function
 def main():
@@ -292,19 +436,31 @@ def main():
     parser.add_argument('--file', type=str, help='Specify the file to process')
     parser.add_argument('--force', action='store_true', help='Force processing of the specified file')
     parser.add_argument('--website', type=str, help='Specify the website name')
+    parser.add_argument('--month', type=year_month, help='Only process (and with --force, purge) this month (YYYY-MM)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Number of rows per multi-row INSERT')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes, each with its own DB connection')
+    parser.add_argument('--fetch-workers', type=int, default=FETCH_WORKERS, help='Number of wikis to fetch valid pages from concurrently')
+    parser.add_argument('--incremental', action='store_true', help='Write only the URL stats that changed since the file was last ingested')
+    parser.add_argument('--bulk', action='store_true', help='Stage URL stats and merge them with LOAD DATA LOCAL INFILE (for full rebuilds)')
+    parser.add_argument('--commit-rows', type=int, default=DEFAULT_COMMIT_ROWS, help='Commit once this many rows are written instead of after every file')
+    parser.add_argument('--purge-batch-size', type=int, default=DEFAULT_PURGE_BATCH_SIZE, help='Number of URLs purged per transaction with --force')
+    parser.add_argument('--metrics-file', type=str, help='Append per-file and per-run metrics to this JSON lines file')
+    parser.add_argument('--prometheus-file', type=str, help='Write run metrics to this Prometheus textfile-collector file')
     args = parser.parse_args()
 
-    global connection
-    connection = get_database_connection()
-    cursor = connection.cursor()
+    if args.bulk and args.incremental:
+        print("--bulk and --incremental cannot be combined.")
+        return
+    if args.bulk and DB_BACKEND != 'mysql':
+        print(f"--bulk loads with LOAD DATA, which the {DB_BACKEND} backend does not support.")
+        return
 
-    directories = [
-        '/var/lib/awstats',
-        '/home/private/server_stats/frankfurt',
-        '/home/private/server_stats/saopaulo',
-        '/home/private/server_stats/singapore'
-    ]
+    global connection
+    connection = get_database_connection(allow_local_infile=args.bulk)
+    cursor = metrics.CountingCursor(get_cursor(connection))
+    create_rollup_tables(cursor)
 
+    directories = DIRECTORIES
     if args.server:
         directories = [dir for dir in directories if args.server in dir]
         if not directories:
@@ -312,103 +468,33 @@ def main():
             return
 
     # If force is True, delete existing data related to the website/server/file
-    if args.force:
-        if args.website:
-            # Get the website_id
-            website_id = get_website_id(cursor, args.website)
-            # Delete stats for the specified website
-            cursor.execute("""
-                DELETE ws FROM website_url_stats ws
-                INNER JOIN website_url wu ON ws.website_url_id = wu.id
-                WHERE wu.website_id = %s
-            """, (website_id,))
-            # Delete unused URLs for the website
-            cursor.execute("""
-                DELETE wu FROM website_url wu
-                LEFT JOIN website_url_stats ws ON wu.id = ws.website_url_id
-                WHERE wu.website_id = %s AND ws.website_url_id IS NULL
-            """, (website_id,))
-        if args.server:
-            # Retrieve 'server_id' based on 'args.server'
-            server_id = get_server_id(f'/home/private/server_stats/{args.server}')
-            if server_id is None:
-                print(f"Invalid server name '{args.server}'")
-                return
-            # Delete stats for the specified server
-            cursor.execute("""
-                DELETE FROM website_url_stats
-                WHERE server_id = %s
-            """, (server_id,))
-            # Delete unused website_url entries
-            cursor.execute("""
-                DELETE wu FROM website_url wu
-                LEFT JOIN website_url_stats ws ON wu.id = ws.website_url_id
-                WHERE ws.website_url_id IS NULL
-            """)
-        if args.file:
-            # Extract website_name, year, and month from args.file
-            filename = args.file
-            filename_without_extension = filename[:-4]  # Remove '.txt'
-            parts = filename_without_extension.split('.')
-            if len(parts) < 2:
-                print(f"Invalid file name format '{args.file}'. Cannot extract website name.")
-                return
-            # Extract website name
-            website_name = '.'.join(parts[1:])
-            # Extract year and month from file name (assuming format 'awstatsMMYYYY')
-            import re
-            match = re.match(r'awstats(\d{2})(\d{4})', filename_without_extension)
-            if match:
-                month_str, year_str = match.groups()
-                month = int(month_str)
-                year = int(year_str)
-            else:
-                print(f"Invalid file name format '{args.file}'. Cannot extract year and month.")
-                return
-            # Get website_id
-            website_id = get_website_id(cursor, website_name)
-            # Delete stats for the specified website, year, and month
-            cursor.execute("""
-                DELETE ws FROM website_url_stats ws
-                INNER JOIN website_url wu ON ws.website_url_id = wu.id
-                WHERE wu.website_id = %s AND ws.year = %s AND ws.month = %s
-            """, (website_id, year, month))
-            # Delete unused URLs for the website if they have no stats
-            cursor.execute("""
-                DELETE wu FROM website_url wu
-                LEFT JOIN website_url_stats ws ON wu.id = ws.website_url_id
-                WHERE wu.website_id = %s AND ws.website_url_id IS NULL
-            """, (website_id,))
-        if not args.website and not args.server and not args.file:
-            # Delete all stats and URLs
-            cursor.execute("DELETE FROM website_url_stats")
-            cursor.execute("DELETE FROM website_url")
-
-    for directory in directories:
-        server_id = get_server_id(directory)
-        if server_id is None:
-            print(f"Server ID not found for directory '{directory}'.")
-            continue
-
-        if args.file:
-            file_path = os.path.join(directory, args.file)
-            if os.path.exists(file_path):
-                process_file(cursor, file_path, server_id, args.force)
-            else:
-                print(f"File '{args.file}' not found in directory '{directory}'.")
-        else:
-            for filename in os.listdir(directory):
-                if filename.endswith('.txt') and 'awstats' in filename:
-                    if args.website:
-                        filename_without_extension = filename[:-4]
-                        website_part = '.'.join(filename.split('.')[1:-1])
-                        if website_part != args.website:
-                            continue
-                    file_path = os.path.join(directory, filename)
-                    process_file(cursor, file_path, server_id, args.force)
+    if args.force and not purge_forced_stats(cursor, args, args.purge_batch_size):
+        return
 
+    # Commit the purge before processing so pool workers do not wait on its locks
     connection.commit()
+
+    # Compare the directory listing against all tracked files at once
+    with metrics.timed('scan'):
+        files = collect_files(directories, args.file, args.website, args.month)
+    with metrics.timed('tracking_check'):
+        pending = filter_unprocessed(cursor, files, SCRIPT_NAME, args.force)
+    # Give new months their partitions before any file transaction is open
+    ensure_file_partitions(cursor, pending, ['website_url_stats'])
     cursor.close()
+    print(f"{len(files) - len(pending)} files have already been processed by {SCRIPT_NAME}.")
+
+    # Only websites with files to process need their valid pages
+    with metrics.timed('api_fetch'):
+        prefetch_websites(pending, args.fetch_workers)
+    groups = group_files_by_website(pending)
+    totals = run_groups(connection, groups, process_group,
+                        (args.force, args.batch_size, args.incremental, args.bulk, args.commit_rows),
+                        args.jobs, {'processed': 0, 'skipped': 0, 'failed': 0}, allow_local_infile=args.bulk)
+    totals['skipped'] += len(files) - len(pending)
+    print(f"{SCRIPT_NAME}: processed {totals['processed']}, skipped {totals['skipped']}, failed {totals['failed']} files.")
+    metrics.write(args.metrics_file, args.prometheus_file, [SCRIPT_NAME], {SCRIPT_NAME: totals})
+
     connection.close()
 
 if __name__ == "__main__":
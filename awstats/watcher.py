@@ -0,0 +1,95 @@
+import os
+import time
+
+from file_tracking import scan_directory
+
+# Watchers report AWStats data files that changed in a set of directories. inotify is used
+# when the optional inotify_simple package is installed; otherwise the directories are
+# polled and files are compared by modification time.
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# AWStats data files are named awstatsMMYYYY.website.txt
+def is_data_file(filename):
+    return filename.endswith('.txt') and 'awstats' in filename
+
+class InotifyWatcher:
+    def __init__(self, directories):
+        self.inotify = INotify()
+        self.directories = {}
+        # AWStats and the region sync both write a temporary file and rename it into place
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO
+        for directory in directories:
+            self.directories[self.inotify.add_watch(directory, mask)] = directory
+
+    # Wait up to timeout seconds and return the paths of the data files that changed
+    def poll(self, timeout):
+        changed = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if is_data_file(event.name):
+                changed.add(os.path.join(self.directories[event.wd], event.name))
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+class PollingWatcher:
+    def __init__(self, directories, interval):
+        self.directories = directories
+        self.interval = interval
+        self.next_scan = 0
+        self.mtimes = self.scan()
+
+    def scan(self):
+        return {path: last_modified for directory in self.directories
+                for path, last_modified in scan_directory(directory)}
+
+    # Wait up to timeout seconds and return the paths of the data files that changed
+    def poll(self, timeout):
+        delay = self.next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(delay, 0))
+        self.next_scan = time.monotonic() + self.interval
+        mtimes = self.scan()
+        changed = {path for path, last_modified in mtimes.items() if self.mtimes.get(path) != last_modified}
+        self.mtimes = mtimes
+        return changed
+
+    def close(self):
+        pass
+
+def get_watcher(directories, poll_interval):
+    if INotify is not None:
+        print("Watching for changes with inotify.")
+        return InotifyWatcher(directories)
+    print(f"inotify_simple is not installed, polling for changes every {poll_interval} seconds.")
+    return PollingWatcher(directories, poll_interval)
+
+# Collect changed paths and release each one once it has been quiet for `debounce` seconds
+class DebouncedQueue:
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self.changed_at = {}
+
+    def add(self, paths):
+        now = time.monotonic()
+        for path in paths:
+            self.changed_at[path] = now
+
+    # Seconds until the next path is ready, or None when the queue is empty
+    def next_timeout(self):
+        if not self.changed_at:
+            return None
+        return max(0, min(self.changed_at.values()) + self.debounce - time.monotonic())
+
+    def pop_ready(self):
+        now = time.monotonic()
+        ready = [path for path, changed in self.changed_at.items() if now - changed >= self.debounce]
+        for path in ready:
+            del self.changed_at[path]
+        return ready
@@ -0,0 +1,23 @@
+from datetime import datetime
+
+from backfill import build_queue, create_checkpoint_table, save_checkpoint
+from sqlite_backend import SQLiteConnection
+
+def test_build_queue(tmp_path):
+    cursor = SQLiteConnection().cursor()
+    create_checkpoint_table(cursor)
+    files = []
+    for filename, size in [('awstats012024.bahai.works.txt', 10), ('awstats022024.bahai.works.txt', 30),
+                           ('awstats032024.bahai.works.txt', 20), ('awstats122023.bahai.works.txt', 40),
+                           ('old-awstats.bahai.works.txt', 50)]:
+        path = tmp_path / filename
+        path.write_bytes(b'x' * size)
+        files.append((str(path), 1, datetime(2024, 4, 1)))
+    save_checkpoint(cursor, 'test', 1, 'awstats022024.bahai.works.txt', 'done', 30, 1.0)
+
+    # Largest first, without finished units, months out of range or names without a month
+    queue, done = build_queue(cursor, files, 'test', (2024, 1), (2024, 3))
+    assert done == 1
+    assert [(file_path.rsplit('/', 1)[1], size) for file_path, server_id, last_modified, size in queue] == [
+        ('awstats032024.bahai.works.txt', 20), ('awstats012024.bahai.works.txt', 10)]
+    assert len(build_queue(cursor, files, 'other', None, None)[0]) == 4
@@ -0,0 +1,45 @@
+from datetime import datetime
+
+from file_tracking import forget_file_tracking
+from sqlite_backend import SQLiteConnection
+
+def tracked(*rows):
+    connection = SQLiteConnection()
+    cursor = connection.cursor()
+    now = datetime(2024, 3, 1)
+    for filename, server_id, script_name in rows:
+        cursor.execute("INSERT INTO file_tracking VALUES (%s, %s, %s, %s, %s)",
+                       (filename, server_id, now, now, script_name))
+    return connection, cursor
+
+def remaining(cursor):
+    cursor.execute("SELECT filename, server_id, script_name FROM file_tracking ORDER BY 1, 2, 3")
+    return cursor.fetchall()
+
+def test_forget_month_of_website_and_server():
+    connection, cursor = tracked(('awstats012024.bahai.works.txt', 1, 'urls'),
+                                 ('awstats012024.bahai.works.txt', 2, 'urls'),
+                                 ('awstats012024.bahai.works.txt', 1, 'summary'),
+                                 ('awstats022024.bahai.works.txt', 1, 'urls'),
+                                 ('awstats012024.bahaipedia.org.txt', 1, 'urls'))
+    assert forget_file_tracking(cursor, 'urls', 'bahai.works', 1, 2024, 1) == 1
+    assert remaining(cursor) == [('awstats012024.bahai.works.txt', 1, 'summary'),
+                                 ('awstats012024.bahai.works.txt', 2, 'urls'),
+                                 ('awstats012024.bahaipedia.org.txt', 1, 'urls'),
+                                 ('awstats022024.bahai.works.txt', 1, 'urls')]
+
+def test_forget_all_months_and_servers_of_website():
+    connection, cursor = tracked(('awstats012024.bahai.works.txt', 1, 'urls'),
+                                 ('awstats022024.bahai.works.txt', 2, 'urls'),
+                                 ('awstats012024.bahaipedia.org.txt', 1, 'urls'))
+    assert forget_file_tracking(cursor, 'urls', 'bahai.works') == 2
+    assert remaining(cursor) == [('awstats012024.bahaipedia.org.txt', 1, 'urls')]
+
+def test_website_name_wildcards_are_literal():
+    connection, cursor = tracked(('awstats012024.a_b.txt', 1, 'urls'),
+                                 ('awstats012024.axb.txt', 1, 'urls'),
+                                 ('awstats012024.50%.txt', 1, 'urls'),
+                                 ('awstats012024.50x.txt', 1, 'urls'))
+    assert forget_file_tracking(cursor, 'urls', 'a_b') == 1
+    assert forget_file_tracking(cursor, 'urls', '50%') == 1
+    assert remaining(cursor) == [('awstats012024.50x.txt', 1, 'urls'), ('awstats012024.axb.txt', 1, 'urls')]
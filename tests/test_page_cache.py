@@ -0,0 +1,182 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from page_cache import MEDIAWIKI_TIMESTAMP, get_cache_connection, get_valid_pages, load_cached_pages
+
+# Stand-in for a wiki's api.php: serves allpages (two titles per response, so the listing has to
+# follow continuation), create/delete/move log events, recent changes and prop=info from its
+# pages, and records the queries it was sent
+class StubWiki:
+    def __init__(self):
+        # Title -> True for a redirect
+        self.pages = {'Home': False, 'Alpha': False, 'Beta': False, 'Gone': True, 'Talk:Chat': False}
+        # (log type, title, target title, timestamp)
+        self.events = []
+        # (change type, title, timestamp)
+        self.changes = []
+        self.queries = []
+        self.failing = set()
+
+    def now(self):
+        return datetime.now(timezone.utc).strftime(MEDIAWIKI_TIMESTAMP)
+
+    def log(self, log_type, title, target=None):
+        self.events.append((log_type, title, target, self.now()))
+
+    def edit(self, title, change_type='edit'):
+        self.changes.append((change_type, title, self.now()))
+
+    def listings(self):
+        return sum(1 for params in self.queries if params.get('list') == 'allpages')
+
+    def checked_titles(self):
+        return {title for params in self.queries if params.get('prop') == 'info' for title in params['titles'].split('|')}
+
+    def respond(self, params):
+        self.queries.append(params)
+        query = params.get('list') or params.get('prop')
+        if query in self.failing:
+            return {'error': {'info': f"{query} unavailable"}}
+        if query == 'allpages':
+            return self.allpages(params)
+        if query == 'logevents':
+            return self.logevents(params)
+        if query == 'recentchanges':
+            return self.recentchanges(params)
+        if query == 'info':
+            return self.info(params)
+        return {'error': {'info': f"unexpected query {params}"}}
+
+    def allpages(self, params):
+        titles = sorted(title for title, redirect in self.pages.items() if not redirect and ':' not in title)
+        titles = [title for title in titles if title >= params.get('apcontinue', '')]
+        data = {'query': {'allpages': [{'ns': 0, 'title': title} for title in titles[:2]]}}
+        if len(titles) > 2:
+            data['continue'] = {'apcontinue': titles[2], 'continue': '-||'}
+        return data
+
+    def logevents(self, params):
+        events = []
+        for log_type, title, target, timestamp in self.events:
+            if log_type == params['letype'] and timestamp >= params['lestart']:
+                event = {'type': log_type, 'title': title, 'timestamp': timestamp}
+                if target:
+                    event['params'] = {'target_title': target}
+                events.append(event)
+        return {'query': {'logevents': events}}
+
+    def recentchanges(self, params):
+        types = params['rctype'].split('|')
+        changes = [{'type': change_type, 'ns': 0, 'title': title, 'timestamp': timestamp}
+                   for change_type, title, timestamp in self.changes
+                   if change_type in types and timestamp >= params['rcstart'] and ':' not in title]
+        return {'query': {'recentchanges': changes}}
+
+    def info(self, params):
+        pages = {}
+        for number, title in enumerate(params['titles'].split('|')):
+            page = {'ns': 1 if title.startswith('Talk:') else 0, 'title': title}
+            if title not in self.pages:
+                pages[str(-1 - number)] = dict(page, missing='')
+                continue
+            if self.pages[title]:
+                page['redirect'] = ''
+            pages[str(number + 1)] = page
+        return {'query': {'pages': pages}}
+
+@pytest.fixture
+def wiki():
+    stub = StubWiki()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+            body = json.dumps(stub.respond(params)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stub.api_url = f"http://127.0.0.1:{server.server_address[1]}/api.php"
+    try:
+        yield stub
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'pages.sqlite')
+
+def refresh(wiki, cache_path, **kwargs):
+    wiki.queries.clear()
+    return set(get_valid_pages('stub.wiki', wiki.api_url, cache_path, **kwargs))
+
+def test_full_refresh_lists_valid_pages(wiki, cache_path):
+    assert refresh(wiki, cache_path) == {'Home', 'Alpha', 'Beta'}
+    assert wiki.listings() == 2
+
+def test_incremental_refresh_applies_log_events(wiki, cache_path):
+    refresh(wiki, cache_path)
+    wiki.pages.update({'Gamma': False, 'Alpha': True, 'Alpha 2': False, 'Talk:Other': False})
+    del wiki.pages['Beta']
+    wiki.log('create', 'Gamma')
+    wiki.log('delete', 'Beta')
+    wiki.log('move', 'Alpha', 'Alpha 2')
+    wiki.log('create', 'Talk:Other')
+
+    assert refresh(wiki, cache_path) == {'Home', 'Gamma', 'Alpha 2'}
+    assert wiki.listings() == 0
+    assert wiki.checked_titles() == {'Gamma', 'Beta', 'Alpha', 'Alpha 2', 'Talk:Other'}
+
+def test_incremental_refresh_picks_up_redirect_edits(wiki, cache_path):
+    refresh(wiki, cache_path)
+    # Turning a page into a redirect, or a redirect back into a page, is an edit without a log entry
+    wiki.pages.update({'Beta': True, 'Gone': False})
+    wiki.edit('Beta')
+    wiki.edit('Gone')
+
+    assert refresh(wiki, cache_path) == {'Home', 'Alpha', 'Gone'}
+    assert wiki.listings() == 0
+    assert wiki.checked_titles() == {'Beta', 'Gone'}
+
+def test_events_before_the_last_sync_are_not_read_again(wiki, cache_path):
+    wiki.events.append(('create', 'Ancient', None, '2001-01-15T00:00:00Z'))
+    refresh(wiki, cache_path)
+    assert refresh(wiki, cache_path) == {'Home', 'Alpha', 'Beta'}
+    assert wiki.checked_titles() == set()
+
+def test_expired_cache_is_listed_again(wiki, cache_path):
+    refresh(wiki, cache_path)
+    wiki.pages['Delta'] = False
+
+    assert 'Delta' in refresh(wiki, cache_path, ttl=timedelta(0))
+    assert wiki.listings() == 2
+
+def test_failed_incremental_refresh_falls_back_to_full_listing(wiki, cache_path):
+    refresh(wiki, cache_path)
+    wiki.pages['Epsilon'] = False
+    wiki.failing.add('logevents')
+
+    assert 'Epsilon' in refresh(wiki, cache_path)
+    assert wiki.listings() == 2
+
+def test_cache_holds_the_last_refresh(wiki, cache_path):
+    pages = refresh(wiki, cache_path)
+    cache = get_cache_connection(cache_path)
+    try:
+        assert set(load_cached_pages(cache, 'stub.wiki')) == pages
+    finally:
+        cache.close()
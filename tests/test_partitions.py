@@ -0,0 +1,93 @@
+import os
+from datetime import date
+
+import pytest
+
+import partitions
+from partitions import (add_months, ensure_month_partitions, file_months, load_month_partitions, migrate_table,
+                        month_range, partition_definitions, truncate_month)
+
+# Cursor that fails on any statement, for code paths that must not query
+class NoQueryCursor:
+    def execute(self, query, params=()):
+        raise AssertionError(f"unexpected query: {query}")
+
+def test_month_helpers():
+    assert add_months(2024, 11, 3) == (2025, 2)
+    assert add_months(2024, 1, -1) == (2023, 12)
+    assert list(month_range((2023, 11), (2024, 2))) == [(2023, 11), (2023, 12), (2024, 1), (2024, 2)]
+    assert partition_definitions([(2024, 12)]) == "PARTITION p202412 VALUES LESS THAN (2025, 1)"
+
+def test_file_months_skips_other_names():
+    files = [('/var/lib/awstats/awstats012024.bahai.works.txt',), ('/var/lib/awstats/awstats.old.txt',),
+             ('/var/lib/awstats/awstats122023.bahai.org.txt',)]
+    assert file_months(files) == {(2024, 1), (2023, 12)}
+
+def test_no_months_needs_no_query(monkeypatch):
+    monkeypatch.setattr(partitions, 'DB_BACKEND', 'mysql')
+    assert ensure_month_partitions(NoQueryCursor(), 'website_url_stats', set()) == 0
+
+# The partition maintenance itself runs against a scratch table in a MySQL database named by
+# AWSTATS_TEST_DATABASE, e.g. a local instance: AWSTATS_TEST_DATABASE=scratch pytest tests
+TEST_DATABASE = os.getenv('AWSTATS_TEST_DATABASE')
+TABLE = 'partition_self_test'
+
+@pytest.fixture
+def cursor(monkeypatch):
+    if not TEST_DATABASE:
+        pytest.skip("AWSTATS_TEST_DATABASE is not set")
+    import mysql.connector
+    import db
+    monkeypatch.setattr(partitions, 'DB_BACKEND', 'mysql')
+    connection = mysql.connector.connect(host=db.db_host, user=db.db_user, password=db.db_password,
+                                         database=TEST_DATABASE)
+    cursor = connection.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    cursor.execute(f"CREATE TABLE {TABLE} (id INT NOT NULL, year INT NOT NULL, month INT NOT NULL, "
+                   f"PRIMARY KEY (id, year, month))")
+    cursor.executemany(f"INSERT INTO {TABLE} (id, year, month) VALUES (%s, %s, %s)",
+                       [(id_, 2024, month) for month in (1, 2, 3) for id_ in range(10)])
+    connection.commit()
+    try:
+        yield cursor
+    finally:
+        cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        cursor.close()
+        connection.close()
+
+def month_count(cursor, year, month):
+    cursor.execute(f"SELECT COUNT(*) FROM {TABLE} WHERE year = %s AND month = %s", (year, month))
+    return cursor.fetchone()[0]
+
+def test_migration_partitions_from_oldest_to_current_month(cursor):
+    assert migrate_table(cursor, TABLE, ahead=0)
+    months = load_month_partitions(cursor, TABLE)
+    today = date.today()
+    assert months[0] == (2024, 1) and months[-1] == (today.year, today.month)
+    # A second migration leaves the table alone
+    assert migrate_table(cursor, TABLE)
+
+def test_new_months_are_split_off_both_ends(cursor):
+    migrate_table(cursor, TABLE, ahead=0)
+    today = date.today()
+    newer = add_months(today.year, today.month, 3)
+    ensure_month_partitions(cursor, TABLE, {(2023, 11), newer})
+    months = load_month_partitions(cursor, TABLE)
+    assert months[0] == (2023, 11) and months[-1] == newer
+    assert months == list(month_range(months[0], months[-1]))
+
+def test_truncate_month(cursor):
+    migrate_table(cursor, TABLE, ahead=0)
+    today = date.today()
+    newer = add_months(today.year, today.month, 3)
+    ensure_month_partitions(cursor, TABLE, {(2023, 11), newer})
+    cursor.execute(f"INSERT INTO {TABLE} (id, year, month) VALUES (1, 2023, 11), (1, {newer[0]}, {newer[1]})")
+
+    # Only the month's partition is emptied
+    assert truncate_month(cursor, TABLE, 2024, 2)
+    assert month_count(cursor, 2024, 2) == 0
+    assert month_count(cursor, 2024, 1) == 10 and month_count(cursor, 2024, 3) == 10 and month_count(cursor, *newer) == 1
+    # The first partition is truncated when it holds only its month
+    assert truncate_month(cursor, TABLE, 2023, 11) and month_count(cursor, 2023, 11) == 0
+    # A month without a partition of its own is left to the caller
+    assert not truncate_month(cursor, TABLE, 2019, 1)